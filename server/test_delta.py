@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Test the delta encoding of video frames in YAIL server
+"""
+import struct
+import logging
+from PIL import Image, ImageDraw
+import yail
+from yail import convertImageToYAIL, delta_frame, frame_image_data, DELTA_BLOCK, GRAPHICS_8, GRAPHICS_9, GRAPHICS_11, VBXE
+from yail_delta import DeltaEncoder
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def make_frame(bar_y: int) -> Image.Image:
+    """A gray frame with a white bar, like a camera frame with something moving"""
+    image = Image.new('RGB', (320, 240), (60, 60, 60))
+    ImageDraw.Draw(image).rectangle((0, bar_y, 319, bar_y + 9), fill=(250, 250, 250))
+    return image
+
+def apply_delta(pixels: bytes, packet: bytes) -> bytes:
+    """Apply a delta packet to image data the way a client does"""
+    block_type, size = struct.unpack_from('<BI', packet, 5)
+    assert block_type == DELTA_BLOCK
+    delta = packet[10:10 + size]
+    out = bytearray(pixels)
+    runs = struct.unpack_from('<H', delta)[0]
+    offset = 2
+    row_bytes = len(pixels) // yail.frame_geometry(packet[3])[1]
+    for _ in range(runs):
+        first, count = struct.unpack_from('<HH', delta, offset)
+        offset += 4
+        out[first * row_bytes:(first + count) * row_bytes] = delta[offset:offset + count * row_bytes]
+        offset += count * row_bytes
+    return bytes(out)
+
+def check_mode(gfx_mode: int, dither: str, palette_mode: str):
+    encoder = DeltaEncoder()
+    key = (gfx_mode, dither, palette_mode)
+    first = bytes(convertImageToYAIL(make_frame(20), gfx_mode, dither, palette_mode))
+    assert delta_frame(encoder, key, first) == first  # the first frame is sent in full
+
+    second = bytes(convertImageToYAIL(make_frame(60), gfx_mode, dither, palette_mode))
+    packet = delta_frame(encoder, key, second)
+    logger.info(f"gfx mode {gfx_mode}: full frame {len(second)} bytes, delta {len(packet)} bytes")
+    assert packet[3] == gfx_mode and len(packet) < len(second)
+    assert apply_delta(bytes(frame_image_data(first)[2]), packet) == bytes(frame_image_data(second)[2])
+
+def test_delta_graphics_8():
+    check_mode(GRAPHICS_8, 'bayer4', 'adaptive')
+
+def test_delta_graphics_9():
+    check_mode(GRAPHICS_9, 'floyd', 'adaptive')
+
+def test_delta_graphics_11():
+    """GRAPHICS_11 is encoded through the VBXE path at 320x240"""
+    check_mode(GRAPHICS_11, 'floyd', 'fixed')
+
+def test_delta_vbxe():
+    check_mode(VBXE, 'floyd', 'fixed')
+
+if __name__ == "__main__":
+    test_delta_graphics_8()
+    test_delta_graphics_9()
+    test_delta_graphics_11()
+    test_delta_vbxe()
@@ -2,12 +2,15 @@
 
 import os
 import argparse
-from typing import List, Union, Callable
-import requests
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Sequence, Set, Tuple, Union, Callable, Hashable, BinaryIO
+from urllib.parse import urlsplit
 import re
 import time
 import logging
-from tqdm import tqdm
+import math
 import socket
 import threading
 from threading import Thread, Lock
@@ -21,6 +24,7 @@ from dotenv import load_dotenv
 from io import BytesIO
 import base64
 import signal
+import struct
 import threading
 import traceback
 
@@ -39,11 +43,111 @@ from yail_gen import (
 # Import camera functionality from yail_camera module
 from yail_camera import (
     init_camera,
-    capture_camera_image,
+    latest_camera_frame,
     shutdown_camera,
+    attach_camera_client,
+    detach_camera_client,
     PYGAME_AVAILABLE
 )
 
+# Import the encoded frame cache
+from yail_cache import (
+    FrameCache,
+    SearchCache,
+    FailureCache,
+    SourceCache,
+    content_hash,
+    DEFAULT_FRAME_CACHE_BYTES,
+    DEFAULT_SEARCH_CACHE_ENTRIES,
+    DEFAULT_SEARCH_CACHE_TTL,
+    DEFAULT_FAILURE_TTL,
+    DEFAULT_SOURCE_CACHE_BYTES
+)
+
+# Import the GRAPHICS_8 dithering methods
+from yail_dither import (
+    dither_to_bits,
+    DITHER_METHODS,
+    ORDERED_DITHERS,
+    DEFAULT_DITHER
+)
+
+# Import the fast VBXE quantizer
+from yail_palette import (
+    get_quantizer,
+    VBXE_PALETTE_MODES,
+    DEFAULT_VBXE_PALETTE
+)
+
+# Import the process pool encoder backend
+from yail_encoder import EncoderPool
+
+# Import the asyncio server mode
+from yail_async import (
+    AsyncClientSocket,
+    DEFAULT_ASYNC_WORKERS
+)
+
+# Import the connection and work limits
+from yail_admission import (
+    AdmissionControl,
+    Overloaded,
+    DEFAULT_MAX_CONVERTS,
+    DEFAULT_QUEUE_SIZE,
+    DEFAULT_QUEUE_TIMEOUT
+)
+
+# Import the buffered send path
+from yail_send import (
+    ClientWriter,
+    SendPump,
+    tune_socket,
+    DEFAULT_SEND_BUFFER
+)
+
+# Import the command line parser
+from yail_protocol import (
+    CommandParser,
+    PARTIAL_LINE_TIMEOUT
+)
+
+# Import the search result prefetcher
+from yail_prefetch import (
+    FramePrefetcher,
+    first_result,
+    DEFAULT_PREFETCH_DEPTH,
+    DEFAULT_PREFETCH_WORKERS,
+    DEFAULT_RACE_WIDTH
+)
+
+# Import the incrementally filled search results
+from yail_search import UrlPool
+
+# Import the broadcast of encoded camera frames
+from yail_broadcast import FrameBroadcast
+
+# Import the delta encoding of video frames
+from yail_delta import DeltaEncoder, DEFAULT_KEYFRAME_INTERVAL
+
+# Import the compression of image blocks
+from yail_compress import rle_encode, CompressionStats, CompressingSocket
+
+# Import the shared HTTP session for downloads
+from yail_http import (
+    create_session,
+    CONNECTION_ERRORS,
+    DEFAULT_POOL_HOSTS,
+    DEFAULT_CONNECTIONS_PER_HOST,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT
+)
+
+# Import the pre-encoded library for files mode
+from yail_library import (
+    YaiLibrary,
+    DEFAULT_RESCAN_SECONDS
+)
+
 # Set up logging first thing
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -51,6 +155,7 @@ logger = logging.getLogger(__name__)
 
 # Constants for image processing
 SOCKET_WAIT_TIME = 1
+CLIENT_TIMEOUT = 300  # 5 minutes timeout
 GRAPHICS_8 = 2
 GRAPHICS_9 = 4
 GRAPHICS_11 = 8
@@ -60,21 +165,64 @@ YAIL_W = 320
 YAIL_H = 220
 VBXE_W = 640
 VBXE_H = 480
+GRAPHICS_9_RASTER = (YAIL_W // 4, YAIL_H)
+YAIL_VBXE_W = 320
+YAIL_VBXE_H = 240
 
 DL_BLOCK = 0x04
 XDL_BLOCK = 0x05
 PALETTE_BLOCK = 0x06
 IMAGE_BLOCK = 0x07
+DELTA_BLOCK = 0x08  # Changed rows against the client's previous frame (see yail_delta)
+IMAGE_RLE_BLOCK = 0x09  # IMAGE_BLOCK compressed with PackBits (see yail_compress)
 ERROR_BLOCK = 0xFF
 
+# Packet layouts.  Version 1.1 has a single memory block, version 1.4 a list of typed blocks.
+YAI_V11_HEADER = struct.Struct("<BBBBBH")   # version (3), gfx mode, block type, block size
+YAI_HEADER = struct.Struct("<BBBBB")        # version (3), gfx mode, number of blocks
+YAI_BLOCK_HEADER = struct.Struct("<BI")     # block type, block size
+DEFAULT_MAX_IMAGE_PIXELS = 50_000_000       # Larger sources are rejected as decompression bombs
+SEARCH_FIRST_PAGE = 50                      # Search results asked for first, to start the first image sooner
+SEARCH_MORE_TIMEOUT = 300                   # Seconds a search waits to be asked for more than its first page
+DEFAULT_MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024  # Larger downloads are abandoned
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+IMAGE_SNIFF_BYTES = 256 * 1024               # A download must be recognizable as an image within this many bytes
+IMAGE_CONTENT_TYPES = ('image/', 'application/octet-stream', 'binary/octet-stream')
+RACE_ROUNDS = 5                             # Rounds of candidates tried before giving up on a random image
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK', 'YCbCr', 'I', 'F')  # Modes Image.reduce() can average
+YAI_EXTENSION = '.yai'                      # Pre-encoded files, e.g. from tools/convert_image_to_YAI.py
+
 # Global variables
-yail_data = bytearray()
-yail_mutex = threading.Lock()
 active_client_threads = []  # Track active client threads
 connections = 0
 filenames = []
 last_prompt = None
 last_gen_model = None
+yai_file_modes = {}  # Graphics mode of each pre-encoded .YAI file in filenames
+frame_cache = FrameCache(DEFAULT_FRAME_CACHE_BYTES)  # Encoded frames shared by all clients
+search_cache = SearchCache(DEFAULT_SEARCH_CACHE_ENTRIES, DEFAULT_SEARCH_CACHE_TTL)  # Search results shared by all clients
+search_cache_file = None  # Where the search cache is kept between runs, if anywhere
+failure_cache = FailureCache(DEFAULT_FAILURE_TTL)  # URLs, hosts and files that recently failed
+source_cache = None  # Downloaded source images kept on disk, if enabled
+library = None  # Pre-encoded frames for the files in --paths, if enabled
+encoder_pool = None  # Worker processes for image conversion, if enabled
+default_dither = DEFAULT_DITHER  # GRAPHICS_8 dither method clients start with
+vbxe_video_palette = DEFAULT_VBXE_PALETTE  # VBXE palette mode for camera frames
+max_image_pixels = DEFAULT_MAX_IMAGE_PIXELS
+video_broadcast = None  # Camera frames encoded once per mode for all video clients
+keyframe_interval = DEFAULT_KEYFRAME_INTERVAL  # Delta video frames between full frames
+compression_stats = CompressionStats()  # Image data sent compressed, across all clients
+max_download_bytes = DEFAULT_MAX_DOWNLOAD_BYTES
+http_session = create_session()  # Keep-alive connections shared by all downloads
+http_timeout = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)  # (connect, read) seconds
+admission = AdmissionControl()  # Connection and work limits, unlimited until configured
+send_pump = None  # Drains the client send buffers in threads mode, if enabled
+send_buffer_bytes = DEFAULT_SEND_BUFFER  # Outbound buffer per client
+so_sndbuf = 0  # Kernel send buffer per client socket (0 keeps the default)
+prefetch_executor = None  # Downloads and encodes search results ahead of the clients, if enabled
+prefetch_depth = DEFAULT_PREFETCH_DEPTH  # Search results each client keeps ready
+race_executor = None  # Tries several candidate images at once after a failure, if enabled
+race_width = DEFAULT_RACE_WIDTH  # Candidates tried at once after a failure
 
 def prep_image_for_vbxe(image: Image.Image, target_width: int=YAIL_W, target_height: int=YAIL_H) -> Image.Image:
     logger.info(f'Image size: {image.size}')
@@ -142,15 +290,57 @@ def fix_aspect(image: Image.Image, crop: bool=False) -> Image.Image:
 
     return image
 
-def dither_image(image: Image.Image) -> Image.Image:
-    return image.convert('1')
+def fit_to_raster(image: Image.Image, raster: Tuple[int, int], crop: bool=False) -> Image.Image:
+    """
+    Fit an image to the YAIL display aspect and resample it straight to the
+    mode's raster in one LANCZOS pass.  The raster may have non-square pixels
+    (GRAPHICS_9 is 80x220 shown as 320x220), so the letterbox or crop box is
+    worked out in display space.  Letterboxing pastes only the resampled
+    picture onto a black raster.
+
+    Args:
+        image: The source image
+        raster: The (width, height) of the mode's pixel raster
+        crop: Crop to fill the frame instead of letterboxing
 
-def pack_bits(image: Image.Image) -> np.ndarray:
-    bits = np.array(image)
+    Returns:
+        The image at raster size
+    """
+    w, h = image.size
+    raster_w, raster_h = raster
+    aspect = YAIL_W/YAIL_H   # YAIL aspect ratio
+
+    if crop:
+        if w/h > aspect:     # wider than YAIL aspect
+            crop_w = h * aspect
+            box = ((w - crop_w) / 2, 0, (w + crop_w) / 2, h)
+        else:                # taller than YAIL aspect
+            crop_h = w / aspect
+            box = (0, (h - crop_h) / 2, w, (h + crop_h) / 2)
+        return image.resize(raster, Image.LANCZOS, box=box)
+
+    scale = min(YAIL_W / w, YAIL_H / h)
+    fit_w = max(1, min(raster_w, round(w * scale * raster_w / YAIL_W)))
+    fit_h = max(1, min(raster_h, round(h * scale * raster_h / YAIL_H)))
+    fitted = image.resize((fit_w, fit_h), Image.LANCZOS)
+    if (fit_w, fit_h) == raster:
+        return fitted
+
+    background = Image.new(image.mode, raster)
+    background.paste(fitted, ((raster_w - fit_w) // 2, (raster_h - fit_h) // 2))
+    return background
+
+def dither_image(image: Image.Image, method: str = DEFAULT_DITHER) -> np.ndarray:
+    return dither_to_bits(image, method)
+
+def pack_bits(image: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    bits = np.asarray(image)
     return np.packbits(bits, axis=1)
 
 def pack_shades(image: Image.Image) -> np.ndarray:
-    yail = image.resize((int(YAIL_W/4),YAIL_H), Image.LANCZOS)
+    yail = image
+    if yail.size != GRAPHICS_9_RASTER:
+        yail = yail.resize(GRAPHICS_9_RASTER, Image.LANCZOS)
     yail = yail.convert(dither=Image.FLOYDSTEINBERG, colors=16)
 
     im_matrix = np.array(yail)
@@ -175,61 +365,180 @@ def show_shades(image_data: np.ndarray) -> None:
     pil_image_yai = Image.fromarray(image_data, mode='L')
     pil_image_yai.resize((320,220), resample=None).show()
 
-def convertToYai(image_data: bytearray, gfx_mode: int) -> bytearray:
-    import struct
+def yai_packet(gfx_mode: int, blocks: List[Tuple[int, int]]) -> Tuple[bytearray, List[memoryview]]:
+    """
+    Preallocate a version 1.4 YAI packet and write its headers.
 
-    ttlbytes = image_data.shape[0] * image_data.shape[1]
+    Args:
+        gfx_mode: The graphics mode stored in the packet header
+        blocks: (block type, payload size) for each memory block, in order
 
-    image_yai = bytearray()
-    image_yai += bytes([1, 1, 0])            # version
-    image_yai += bytes([gfx_mode])           # Gfx mode (8,9)
-    image_yai += bytes([3])                  # Memory block type
-    image_yai += struct.pack("<H", ttlbytes) # num bytes height x width
-    image_yai += bytearray(image_data)       # image
+    Returns:
+        The packet and a writable view onto each block's payload, to be filled in place
+    """
+    size = YAI_HEADER.size + sum(YAI_BLOCK_HEADER.size + block_size for _, block_size in blocks)
+    packet = bytearray(size)
+    YAI_HEADER.pack_into(packet, 0, 1, 4, 0, gfx_mode, len(blocks))
+
+    view = memoryview(packet)
+    payloads = []
+    offset = YAI_HEADER.size
+    for block_type, block_size in blocks:
+        YAI_BLOCK_HEADER.pack_into(packet, offset, block_type, block_size)
+        offset += YAI_BLOCK_HEADER.size
+        payloads.append(view[offset:offset + block_size])
+        offset += block_size
+
+    return packet, payloads
+
+def as_byte_view(data: Union[bytes, bytearray, memoryview, np.ndarray, List[int]]) -> memoryview:
+    """
+    Return a flat unsigned byte view of data without copying it (lists of ints are packed once).
+    """
+    if isinstance(data, np.ndarray):
+        return memoryview(np.ascontiguousarray(data).view(np.uint8)).cast('B')
+    if isinstance(data, list):
+        return memoryview(bytes(data))
+    return memoryview(data).cast('B')
+
+def convertToYai(image_data: np.ndarray, gfx_mode: int) -> bytearray:
+    pixels = as_byte_view(image_data)
+    ttlbytes = len(pixels)                   # num bytes height x width
+
+    image_yai = bytearray(YAI_V11_HEADER.size + ttlbytes)
+    YAI_V11_HEADER.pack_into(image_yai, 0, 1, 1, 0, gfx_mode, 3, ttlbytes)  # version, gfx mode (8,9), memory block type, size
+    image_yai[YAI_V11_HEADER.size:] = pixels # image
 
     logger.debug(f'YAI size: {len(image_yai)}')
 
     return image_yai
 
-def createErrorPacket(error_message: str, gfx_mode: int) -> bytearray:
-    import struct
+def frame_blocks(payload: bytes) -> Tuple[Optional[int], List[Tuple[int, memoryview]]]:
+    """
+    Split an encoded packet into its blocks.  The single memory block of a
+    version 1.1 packet is returned as an IMAGE_BLOCK.
 
+    Returns:
+        tuple: (gfx mode, [(block type, block data)]), or (None, []) if payload is not a YAI packet
+    """
+    view = memoryview(payload)
+    if len(payload) < YAI_V11_HEADER.size or payload[0] != 1:
+        return None, []
+
+    if payload[1] == 1:  # version 1.1, a single memory block
+        _, _, _, gfx_mode, _, size = YAI_V11_HEADER.unpack_from(payload)
+        return gfx_mode, [(IMAGE_BLOCK, view[YAI_V11_HEADER.size:YAI_V11_HEADER.size + size])]
+
+    if payload[1] != 4:
+        return None, []
+
+    _, _, _, gfx_mode, count = YAI_HEADER.unpack_from(payload)
+    blocks = []
+    offset = YAI_HEADER.size
+    for _ in range(count):
+        block_type, size = YAI_BLOCK_HEADER.unpack_from(payload, offset)
+        offset += YAI_BLOCK_HEADER.size
+        blocks.append((block_type, view[offset:offset + size]))
+        offset += size
+    return gfx_mode, blocks
+
+def frame_image_data(payload: bytes) -> Tuple[int, Optional[bytes], Optional[memoryview]]:
+    """
+    Find the palette and image data in an encoded frame.
+
+    Returns:
+        tuple: (gfx mode, palette or None, image data or None)
+    """
+    gfx_mode, blocks = frame_blocks(payload)
+    palette = pixels = None
+    for block_type, data in blocks:
+        if block_type == PALETTE_BLOCK:
+            palette = bytes(data)
+        elif block_type == IMAGE_BLOCK:
+            pixels = data
+    return gfx_mode, palette, pixels
+
+def compress_frame(payload: bytes) -> bytes:
+    """
+    Replace the IMAGE_BLOCK of a frame with an IMAGE_RLE_BLOCK when that is
+    smaller.  Anything without image data (text responses, errors, delta
+    frames) is returned unchanged.
+    """
+    gfx_mode, blocks = frame_blocks(payload)
+    if not any(block_type == IMAGE_BLOCK for block_type, _ in blocks):
+        return payload
+
+    packed = []
+    raw_bytes = sent_bytes = 0
+    for block_type, data in blocks:
+        if block_type == IMAGE_BLOCK:
+            compressed = rle_encode(data)
+            raw_bytes += len(data)
+            if len(compressed) < len(data):
+                block_type, data = IMAGE_RLE_BLOCK, compressed
+            sent_bytes += len(data)
+        packed.append((block_type, data))
+
+    compression_stats.record(raw_bytes, sent_bytes)
+    if sent_bytes == raw_bytes:
+        return payload
+
+    logger.debug(f'Compressed image data {raw_bytes} -> {sent_bytes} bytes')
+    packet, views = yai_packet(gfx_mode, [(block_type, len(data)) for block_type, data in packed])
+    for view, (_, data) in zip(views, packed):
+        view[:] = data
+    return packet
+
+def delta_frame(encoder: DeltaEncoder, key: Hashable, payload: bytes) -> bytes:
+    """
+    Turn an encoded video frame into a delta packet against the client's
+    previous frame, or leave it a full frame when that is needed or smaller.
+    """
+    gfx_mode, palette, pixels = frame_image_data(payload)
+    if pixels is None:
+        encoder.reset()
+        return payload
+
+    # The rows of the raster the encoder fitted the frame to
+    rows = frame_geometry(gfx_mode)[1]
+    if len(pixels) % rows != 0:
+        logger.warning(f'{len(pixels)} bytes of gfx mode {gfx_mode} image data are not {rows} rows, sending a full frame')
+        encoder.reset()
+        return payload
+
+    delta = encoder.encode(key, palette, pixels, len(pixels) // rows)
+    if delta is None:
+        return payload
+
+    packet, (delta_block,) = yai_packet(gfx_mode, [(DELTA_BLOCK, len(delta))])
+    delta_block[:] = delta
+    return packet
+
+def createErrorPacket(error_message: bytes, gfx_mode: int) -> bytearray:
     logger.debug(f'Error message length: {len(error_message)}')
 
-    error_packets = bytearray()
-    error_packets += bytes([1, 4, 0])                      # version
-    error_packets += bytes([gfx_mode])                     # Gfx mode (8,9)
-    error_packets += struct.pack("<B", 1)                  # number of memory blocks
-    error_packets += bytes([ERROR_BLOCK])                  # Memory block type
-    error_packets += struct.pack("<I", len(error_message)) # error message size
-    error_packets += bytearray(error_message)              # error
+    error_packets, (error_block,) = yai_packet(gfx_mode, [(ERROR_BLOCK, len(error_message))])
+    error_block[:] = as_byte_view(error_message)   # error
 
     return error_packets
 
 
 def convertToYaiVBXE(image_data: bytes, palette_data: bytes, gfx_mode: int) -> bytearray:
-    import struct
-
     # Log information about the source image
     logger.debug(f'Image data size: {len(image_data)}')
     logger.debug(f'Palette data size: {len(palette_data)}')
 
-    image_yai = bytearray()
-    image_yai += bytes([1, 4, 0])            # version
-    image_yai += bytes([gfx_mode])           # Gfx mode (8,9)
-    image_yai += struct.pack("<B", 2)        # number of memory blocks
-    image_yai += bytes([PALETTE_BLOCK])             # Memory block type
-    image_yai += struct.pack("<I", len(palette_data)) # palette size
-    image_yai += bytearray(palette_data)  # palette
-    image_yai += bytes([IMAGE_BLOCK])                  # Memory block type
-    image_yai += struct.pack("<I", len(image_data)) # num bytes height x width
-    image_yai += bytearray(image_data)       # image
+    image_yai, (palette_block, image_block) = yai_packet(gfx_mode, [(PALETTE_BLOCK, len(palette_data)),
+                                                                    (IMAGE_BLOCK, len(image_data))])
+    palette_block[:] = as_byte_view(palette_data) # palette
+    image_block[:] = as_byte_view(image_data)     # image
 
     logger.debug(f'YAI size: {len(image_yai)}')
 
     return image_yai
 
-def convertImageToYAIL(image: Image.Image, gfx_mode: int) -> bytearray:
+def convertImageToYAIL(image: Image.Image, gfx_mode: int, dither: str = DEFAULT_DITHER,
+                       palette_mode: str = DEFAULT_VBXE_PALETTE) -> bytearray:
     # Log information about the source image
     logger.debug(f'Source Image size: {image.size}')
     logger.debug(f'Source Image mode: {image.mode}')
@@ -237,9 +546,7 @@ def convertImageToYAIL(image: Image.Image, gfx_mode: int) -> bytearray:
     logger.debug(f'Source Image info: {image.info}')
 
     if gfx_mode == GRAPHICS_8 or gfx_mode == GRAPHICS_9:
-        gray = image.convert(mode='L')
-        gray = fix_aspect(gray)
-        gray = gray.resize((YAIL_W,YAIL_H), Image.LANCZOS)
+        gray = fit_gray(image, gfx_mode)
 
         logger.debug(f'Processed Image size: {image.size}')
         logger.debug(f'Processed Image mode: {image.mode}')
@@ -247,7 +554,7 @@ def convertImageToYAIL(image: Image.Image, gfx_mode: int) -> bytearray:
         logger.debug(f'Processed Image info: {image.info}')
 
         if gfx_mode == GRAPHICS_8:
-            gray_dithered = dither_image(gray)
+            gray_dithered = dither_image(gray, dither)
             image_data = pack_bits(gray_dithered)
         elif gfx_mode == GRAPHICS_9:
             image_data = pack_shades(gray)
@@ -256,171 +563,603 @@ def convertImageToYAIL(image: Image.Image, gfx_mode: int) -> bytearray:
 
     else: # gfx_mode == VBXE:
         # Make the image fit out screen format but preserve it's aspect ratio
-        image_resized = prep_image_for_vbxe(image, target_width=320, target_height=240)
+        image_resized = prep_image_for_vbxe(image, target_width=YAIL_VBXE_W, target_height=YAIL_VBXE_H)
+        palette, pixels = quantize_vbxe(image_resized, palette_mode, dither)
+        image_yai = vbxe_packet(palette, pixels, gfx_mode)
+
+    return image_yai
+
+def fit_gray(image: Image.Image, gfx_mode: int) -> Image.Image:
+    """
+    Convert an image to grayscale and resample it once, straight to the
+    mode's raster (GRAPHICS_9 packs 4 bit pixels at a quarter of the width).
+    """
+    gray = image if image.mode == 'L' else image.convert(mode='L')
+    return fit_to_raster(gray, GRAPHICS_9_RASTER if gfx_mode == GRAPHICS_9 else (YAIL_W, YAIL_H))
+
+def quantize_vbxe(image: Image.Image, palette_mode: str, dither: str) -> Tuple[Sequence[int], np.ndarray]:
+    """
+    Reduce a fitted VBXE frame to 256 colors.
+
+    Returns:
+        tuple: (flat RGB palette, 2D array of palette indices)
+    """
+    if palette_mode == 'adaptive':
         # Convert the image to use a palette
-        image_resized = image_resized.convert('P', palette=Image.ADAPTIVE, colors=256)
-        logger.info(f'Image size: {image_resized.size}')
-        #image_resized.show()
-        # Get the palette
-        palette = image_resized.getpalette()
-        # Get the image data
-        image_resized = image_resized.tobytes()
-        logger.info(f'Image data size: {len(image_resized)}')
-        # Offset the palette entries by one
-        offset_palette = [0] * 3 + palette[:-3]
-        # Offset the image data by one
-        offset_image_data = bytes((byte + 1) % 256 for byte in image_resized)
-
-        image_yai = convertToYaiVBXE(offset_image_data, offset_palette, gfx_mode)
+        image = image.convert('P', palette=Image.ADAPTIVE, colors=256)
+        logger.info(f'Image size: {image.size}')
+        palette, pixels = image.getpalette(), np.asarray(image)
+    else:
+        # Map the pixels through the fixed or tracking palette's lookup table
+        palette, pixels = get_quantizer(palette_mode).quantize(image, dither if dither in ORDERED_DITHERS else None)
+    logger.info(f'Image data size: {pixels.size}')
+    return palette, pixels
+
+def vbxe_packet(palette: Sequence[int], pixels: np.ndarray, gfx_mode: int = VBXE) -> bytearray:
+    """
+    Build the YAI packet of a quantized VBXE frame.  Color 0 is reserved, so
+    the palette and the pixel indices are offset by one.
+    """
+    image_yai, (palette_block, image_block) = yai_packet(gfx_mode, [(PALETTE_BLOCK, len(palette)),
+                                                                    (IMAGE_BLOCK, pixels.size)])
+    # Offset the palette entries by one
+    palette_block[3:] = bytes(palette[:-3])
+    # Offset the image data by one, wrapping at 256, straight into the packet
+    np.add(pixels, 1, out=np.frombuffer(image_block, dtype=np.uint8).reshape(pixels.shape))
 
+    logger.debug(f'YAI size: {len(image_yai)}')
     return image_yai
 
-def update_yail_data(data: np.ndarray, gfx_mode: int, thread_safe: bool = True) -> None:
-    global yail_data
-    if thread_safe:
-        yail_mutex.acquire()
-    try:
-        yail_data = data #convertToYai(data, gfx_mode)
-    finally:
-        if thread_safe:
-            yail_mutex.release()
+def encode_image(image: Image.Image, gfx_mode: int, dither: str = DEFAULT_DITHER,
+                 palette_mode: str = DEFAULT_VBXE_PALETTE) -> bytearray:
+    """
+    Convert a decoded image to a YAI payload, in the encoder pool if there is one.
+    """
+    with admission.work('convert'):
+        if encoder_pool is not None:
+            return encoder_pool.encode_image(image, gfx_mode, dither, palette_mode)
+        return convertImageToYAIL(image, gfx_mode, dither, palette_mode)
+
+def video_key(gfx_mode: int, dither: str) -> Tuple[int, Optional[str], Optional[str]]:
+    """
+    The encoding options that change a camera frame, for sharing it between clients.
+    The VBXE lookup table palettes use the dither method too.
+    """
+    if gfx_mode == VBXE:
+        return (gfx_mode, dither if vbxe_video_palette != 'adaptive' else None, vbxe_video_palette)
+    return (gfx_mode, encode_variant(gfx_mode, dither), None)
+
+def encode_video_frame(image: Image.Image, key: Tuple[int, Optional[str], Optional[str]]) -> bytearray:
+    """
+    Convert a camera frame for the broadcast.
+    """
+    gfx_mode, dither, palette_mode = key
+    return encode_image(image, gfx_mode, dither or DEFAULT_DITHER, palette_mode or DEFAULT_VBXE_PALETTE)
+
+def frame_geometry(gfx_mode: int) -> Tuple[int, int]:
+    """
+    The (width, height) a source image is fitted to for a graphics mode.
+    """
+    if gfx_mode == GRAPHICS_8 or gfx_mode == GRAPHICS_9:
+        return (YAIL_W, YAIL_H)
+    return (YAIL_VBXE_W, YAIL_VBXE_H)
+
+def open_source_image(fp, gfx_mode: int) -> Image.Image:
+    """
+    Open a source image, decoding it no larger than the graphics mode needs.
+    JPEGs are decoded at the smallest DCT scale that still covers the fitted
+    frame (draft mode); other formats are shrunk by an integer factor with
+    reduce() before any geometry work.
+
+    Args:
+        fp: A filename or file object
+        gfx_mode: The graphics mode the image will be converted for
+
+    Returns:
+        The (possibly reduced) image
 
-def send_yail_data(client_socket: socket.socket, thread_safe: bool=True) -> None:
-    global yail_data
+    Raises:
+        ValueError: If the image has more than max_image_pixels pixels
+    """
+    image = Image.open(fp)
+    w, h = image.size
+    if w * h > max_image_pixels:
+        image.close()
+        raise ValueError(f'Image of {w}x{h} exceeds the {max_image_pixels} pixel limit')
+
+    # The size of the image once fitted inside the frame
+    target_w, target_h = frame_geometry(gfx_mode)
+    scale = min(target_w / w, target_h / h)
+    fit_w, fit_h = max(1, math.ceil(w * scale)), max(1, math.ceil(h * scale))
+
+    if image.format == 'JPEG':
+        draft_mode = 'L' if gfx_mode == GRAPHICS_8 or gfx_mode == GRAPHICS_9 else 'RGB'
+        image.draft(draft_mode, (fit_w, fit_h))
+    else:
+        factor = min(w // fit_w, h // fit_h)
+        if factor >= 2 and image.mode in REDUCIBLE_MODES:
+            image = image.reduce(factor)
+
+    if image.size != (w, h):
+        logger.debug(f'Decoded {w}x{h} source at {image.size}')
+
+    return image
+
+def encode_variant(gfx_mode: int, dither: str) -> Optional[str]:
+    """
+    The encoding options that change the output of a graphics mode, for cache keys.
+    """
+    return dither if gfx_mode == GRAPHICS_8 else None
+
+def encode_source(image_data: bytes, gfx_mode: int, dither: str = DEFAULT_DITHER) -> bytes:
+    """
+    Convert the raw bytes of a source image to a YAI payload, reusing a
+    previously encoded frame for the same content and mode when there is one.
+
+    Args:
+        image_data: The encoded source image (JPEG, PNG, GIF, ...)
+        gfx_mode: The graphics mode to use
+        dither: The GRAPHICS_8 dither method
+
+    Returns:
+        The YAI payload
+    """
+    key = FrameCache.key(content_hash(image_data), gfx_mode, frame_geometry(gfx_mode), encode_variant(gfx_mode, dither))
+    image_yai = frame_cache.get(key)
+    if image_yai is not None:
+        logger.debug(f'Frame cache hit {key}')
+        return image_yai
+
+    with admission.work('convert'):
+        if encoder_pool is not None:
+            image_yai = encoder_pool.encode_bytes(image_data, gfx_mode, dither)
+        else:
+            image = open_source_image(BytesIO(image_data), gfx_mode)
+            image_yai = convertImageToYAIL(image, gfx_mode, dither)
+    frame_cache.put(key, image_yai)
+
+    return image_yai
+
+def read_yai_file_mode(filepath: str) -> Optional[int]:
+    """
+    Read the header of a pre-encoded .YAI file.
+
+    Args:
+        filepath: Path of the .YAI file
 
-    if thread_safe:
-        yail_mutex.acquire()
+    Returns:
+        The graphics mode the file was encoded for, or None if it is not a valid YAI file
+    """
     try:
-        data = yail_data   # a local copy
-    finally:
-        if thread_safe:
-            yail_mutex.release()
+        with open(filepath, 'rb') as f:
+            header = f.read(YAI_V11_HEADER.size)
+            file_size = os.fstat(f.fileno()).st_size
+    except OSError as e:
+        logger.warning(f'Could not read {filepath}: {e}')
+        return None
+
+    if len(header) < YAI_HEADER.size or header[0] != 1:
+        return None
+
+    if header[1] == 1:     # version 1.1, a single memory block
+        if len(header) < YAI_V11_HEADER.size:
+            return None
+        _, _, _, gfx_mode, _, ttlbytes = YAI_V11_HEADER.unpack(header)
+        if ttlbytes != file_size - YAI_V11_HEADER.size:
+            return None
+        return gfx_mode
+    elif header[1] == 4:   # version 1.4, a list of memory blocks
+        return header[3]
+
+    return None
+
+def open_yai_file(filepath: str, gfx_mode: int) -> Optional[BinaryIO]:
+    """
+    Open a pre-encoded .YAI file to be sent as is, using the kernel's
+    zero-copy sendfile where available (socket.sendfile falls back to
+    buffered sends otherwise).
+
+    Args:
+        filepath: Path of the .YAI file
+        gfx_mode: The client's current graphics mode, which the file must match
 
-    if data is not None:
-        client_socket.sendall(data)
-        logger.info('Sent YAIL data')
+    Returns:
+        The open file, or None if it is for another graphics mode
+    """
+    file_mode = yai_file_modes.get(filepath) or read_yai_file_mode(filepath)
+    if file_mode != gfx_mode:
+        logger.warning(f'{filepath} is for gfx mode {file_mode}, client is in {gfx_mode}')
+        return None
+
+    return open(filepath, 'rb')
 
-def stream_YAI(client: str, gfx_mode: int, url: str = None, filepath: str = None) -> bool:
-    from io import BytesIO
+def encode_file(filepath: str, gfx_mode: int) -> bytearray:
+    """
+    Convert an image file to a YAI payload with the server's default options.
+    Used to build the library packs.
+    """
+    with open_source_image(filepath, gfx_mode) as image:
+        return convertImageToYAIL(image, gfx_mode, default_dither)
 
-    global YAIL_H
+def check_image_header(data: bytes, complete: bool) -> bool:
+    """
+    Identify a source image from its first bytes and check its size.  Only
+    the header is parsed; nothing is decoded.
 
-    # download the body of response by chunk, not immediately
+    Args:
+        data: The start of the encoded image
+        complete: True if no more data is coming, so an unidentified image is an error
+
+    Returns:
+        True if the image was identified, False if more data is needed
+
+    Raises:
+        ValueError: If the data is not an image or has more than max_image_pixels pixels
+    """
     try:
-        if url is not None:
-            logger.info(f'Loading {url}')
+        with Image.open(BytesIO(data)) as image:
+            w, h = image.size
+    except (OSError, SyntaxError):
+        if complete:
+            raise ValueError('Not a recognized image')
+        return False
 
-            file_size = 0
+    if w * h > max_image_pixels:
+        raise ValueError(f'Image of {w}x{h} exceeds the {max_image_pixels} pixel limit')
+    return True
 
-            response = requests.get(url, stream=True, timeout=5)
+def download_image(url: str) -> Union[bytearray, bytes]:
+    """
+    Download a source image in large chunks, into a buffer preallocated from
+    Content-Length when the server sends one.  The image header is identified
+    as soon as it has arrived, so oversized and non-image downloads are
+    abandoned without reading the rest.  Images already in the source cache
+    are not downloaded again.
 
-            # get the file name
-            filepath = ''
-            exts = ['.jpg', '.jpeg', '.gif', '.png']
-            ext = re.findall('|'.join(exts), url)
-            if len(ext):
-                pos_ext = url.find(ext[0])
-                if pos_ext >= 0:
-                    pos_name = url.rfind("/", 0, pos_ext)
-                    filepath =  url[pos_name+1:pos_ext+4]
+    Args:
+        url: The image URL
 
-            # progress bar, changing the unit to bytes instead of iteration (default by tqdm)
-            image_data = b''
-            progress = tqdm(response.iter_content(256), f"Downloading {filepath}", total=file_size, unit="B", unit_scale=True, unit_divisor=256)
-            for data in progress:
-                # collect all the data
-                image_data += data
+    Returns:
+        The encoded source image
 
-                # update the progress bar manually
-                progress.update(len(data))
+    Raises:
+        ValueError: If the response is not an image, is larger than
+            max_download_bytes or has more than max_image_pixels pixels
+    """
+    logger.info(f'Loading {url}')
+
+    if source_cache is not None:
+        image_data = source_cache.get(url)
+        if image_data is not None:
+            logger.debug(f'Source cache hit {url}')
+            return image_data
+
+    with admission.work('download'):
+        with http_session.get(url, stream=True, timeout=http_timeout) as response:
+            response.raise_for_status()
+
+            content_type = response.headers.get('Content-Type', '').lower()
+            if content_type and not content_type.startswith(IMAGE_CONTENT_TYPES):
+                raise ValueError(f'Not an image: {content_type}')
+
+            content_length = int(response.headers.get('Content-Length') or 0)
+            if content_length > max_download_bytes:
+                raise ValueError(f'Image of {content_length} bytes exceeds the {max_download_bytes} byte limit')
+
+            image_data = bytearray(content_length)
+            size = 0
+            identified = False
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                end = size + len(chunk)
+                if end > max_download_bytes:
+                    raise ValueError(f'Image exceeds the {max_download_bytes} byte limit')
+                image_data[size:end] = chunk  # in place within Content-Length, growing past it
+                size = end
+
+                if not identified:
+                    identified = check_image_header(image_data[:size], size >= IMAGE_SNIFF_BYTES)
+
+            del image_data[size:]
+            if not identified:
+                check_image_header(image_data, True)
+
+    logger.debug(f'Downloaded {size} bytes from {url}')
+    if source_cache is not None:
+        source_cache.put(url, image_data)
+    return image_data
+
+def stream_YAI(client: str, gfx_mode: int, url: str = None, filepath: str = None, dither: str = DEFAULT_DITHER) -> bool:
+    yai_file = None
 
-            image_bytes_io = BytesIO()
-            image_bytes_io.write(image_data)
-            image = Image.open(image_bytes_io)
+    try:
+        if url is not None:
+            image_yai = encode_source(download_image(url), gfx_mode, dither)
 
         elif filepath is not None:
-            image = Image.open(filepath)
+            if filepath.lower().endswith(YAI_EXTENSION):
+                yai_file = open_yai_file(filepath, gfx_mode)
+                if yai_file is None:
+                    return False
+            else:
+                image_yai = load_file_frame(filepath, gfx_mode, dither)
 
-        image_yai = convertImageToYAIL(image, gfx_mode)
+    except Overloaded:
+        raise  # not a problem with this image, so trying another would not help
+    except Exception as e:
+        logger.error(f'Exception: {e}')
+        return False
 
+    # Outside the try: a client that has gone away is not a problem with the image
+    if yai_file is not None:
+        with yai_file:
+            client.sendfile(yai_file)
+    else:
         client.sendall(image_yai)
 
+    return True
+
+def load_file_frame(filepath: str, gfx_mode: int, dither: str = DEFAULT_DITHER) -> bytes:
+    """
+    The YAI payload for an image file, from the library, the file itself if
+    it is pre-encoded, or by encoding it.
+
+    Raises:
+        ValueError: If a pre-encoded file is for another graphics mode
+    """
+    if filepath.lower().endswith(YAI_EXTENSION):
+        file_mode = yai_file_modes.get(filepath) or read_yai_file_mode(filepath)
+        if file_mode != gfx_mode:
+            raise ValueError(f'{filepath} is for gfx mode {file_mode}, client is in {gfx_mode}')
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    if library is not None and encode_variant(gfx_mode, dither) == encode_variant(gfx_mode, default_dither):
+        image_yai = library.get(filepath, gfx_mode)
+        if image_yai is not None:
+            return image_yai
+
+    with open(filepath, 'rb') as f:
+        return encode_source(f.read(), gfx_mode, dither)
+
+def url_host(url: str) -> Tuple[str, str]:
+    """
+    The failure cache key of the host a URL is on.
+    """
+    return ('host', urlsplit(url).netloc)
+
+def record_failure(candidate: str, error: Optional[Exception] = None) -> None:
+    """
+    Put an image URL or file that failed in the failure cache, and the URL's
+    host too if the host could not be reached.
+    """
+    failure_cache.add(candidate)
+    if isinstance(error, CONNECTION_ERRORS):
+        failure_cache.add(url_host(candidate))
+
+def has_failed(candidate: str) -> bool:
+    """
+    True if an image URL, its host, or an image file recently failed.
+    """
+    if candidate in failure_cache:
         return True
+    return candidate.startswith(('http://', 'https://')) and url_host(candidate) in failure_cache
 
-    except Exception as e:
-        logger.error(f'Exception: {e} **{file_size}')
-        return False
+def pick_candidates(candidates: Sequence[str], count: int, tried: Set[str]) -> List[str]:
+    """
+    Pick up to count random candidates that have not been tried and have not
+    recently failed.
+    """
+    picked = []
+    for index in random.sample(range(len(candidates)), len(candidates)):
+        candidate = candidates[index]
+        if candidate not in tried and not has_failed(candidate):
+            picked.append(candidate)
+            if len(picked) == count:
+                break
+    return picked
+
+def race_for_frame(candidates: Sequence[str], produce: Callable[[str], bytes],
+                   tried: Optional[Set[str]] = None, first_count: int = 1) -> Optional[bytes]:
+    """
+    Produce a frame from a random candidate image.  The first round tries
+    first_count candidates; once a round has failed, the next tries
+    race_width at once and the first to succeed wins.  Candidates that fail
+    go into the failure cache.
+
+    Args:
+        candidates: Image URLs or files
+        produce: Produces the YAI payload for a candidate, raising if it cannot
+        tried: Candidates already tried, which are skipped
+        first_count: Candidates to try in the first round
+
+    Returns:
+        The YAI payload, or None if no candidate worked
+    """
+    tried = set() if tried is None else tried
+
+    def attempt(candidate: str) -> Optional[bytes]:
+        try:
+            return produce(candidate)
+        except Overloaded:
+            raise
+        except Exception as e:
+            logger.warning(f'Problem with {candidate}: {e}')
+            record_failure(candidate, e)
+            return None
+
+    count = first_count
+    for _ in range(RACE_ROUNDS):
+        batch = pick_candidates(candidates, count, tried)
+        if not batch:
+            break
+        if race_executor is None:
+            batch = batch[:1]
+        tried.update(batch)
+        image_yai = first_result(race_executor, attempt, batch)
+        if image_yai is not None:
+            return image_yai
+        count = race_width
+
+    return None
 
 # This uses the DuckDuckGo search engine to find images.  This is handled by the duckduckgo_search package.
-def search_images(term: str, max_images: int=1000) -> List[str]:
+def iter_search_images(term: str, max_images: int=1000, more: Optional[threading.Event] = None,
+                       first_page: Optional[List[str]] = None) -> Iterator[str]:
     """
-    Search for images using DuckDuckGo and return a list of URLs.
-    
+    Search for images using DuckDuckGo, yielding URLs as the results arrive.
+    A small first page is fetched (or taken from first_page, if it was
+    cached); the full results are only fetched once more is set, and the
+    search ends without them if it is not set within SEARCH_MORE_TIMEOUT.
+    Both pages are stored in the search cache, the full results only once
+    they have been fetched.
+
     Args:
         term (str): The search term
         max_images (int): Maximum number of images to return
-        
-    Returns:
-        List[str]: List of image URLs
+        more: Set when the consumer needs more than the first page (None fetches everything)
+        first_page: The cached first page, if there is one
+
+    Yields:
+        str: Image URLs
     """
-    try:
+    def search(max_results: int) -> List[str]:
         from ddgs import DDGS
-        results = DDGS().images(query=term, max_results=max_images)
-        
-        # Extract image URLs from results
-        urls = [result['image'] for result in results]
+        with admission.work('search'):
+            return [result['image'] for result in DDGS().images(query=term, max_results=max_results)]
+
+    try:
+        urls = []
+        seen = set()
+        first = min(SEARCH_FIRST_PAGE, max_images)
+
+        if first_page is None:
+            first_page = search(first)
+            search_cache.put(term, first, first_page)
+        # A first page short of what was asked for holds every result there is
+        complete = first == max_images or len(first_page) < first
+
+        for url in first_page:
+            if url not in seen:
+                seen.add(url)
+                urls.append(url)
+                yield url
+
+        if not complete and (more is None or more.wait(SEARCH_MORE_TIMEOUT)):
+            for url in search(max_images):
+                if url not in seen:
+                    seen.add(url)
+                    urls.append(url)
+                    yield url
+            complete = True
+
         logger.info(f"Found {len(urls)} images for search term: '{term}'")
-        return urls
+        if complete:
+            search_cache.put(term, max_images, urls)
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Error searching for images '{term}': {e}")
-        return []
 
-def stream_random_image_from_urls(client_socket: socket.socket, urls: list, gfx_mode: int) -> None:
+def search_images(term: str, max_images: int=1000) -> UrlPool:
+    """
+    Search for images using DuckDuckGo.  Returns as soon as the first URL is
+    in; the rest of the first page fills the pool in the background, and
+    the full results once the pool's want_more() is called.
+    Results are shared between clients through the search cache.
+    
+    Args:
+        term (str): The search term
+        max_images (int): Maximum number of images to return
+        
+    Returns:
+        UrlPool: The image URLs, used like a list
+    """
+    urls = search_cache.get(term, max_images)
+    if urls is not None:
+        logger.info(f"Found {len(urls)} cached images for search term: '{term}'")
+        return UrlPool(urls, background=False)
+
+    first_page = search_cache.get(term, SEARCH_FIRST_PAGE) if max_images > SEARCH_FIRST_PAGE else None
+    more = threading.Event()
+    pool = UrlPool(iter_search_images(term, max_images, more, first_page), more=more)
+    pool.wait()
+    return pool
+
+def stream_random_image_from_urls(client_socket: socket.socket, urls: list, gfx_mode: int, dither: str = DEFAULT_DITHER) -> None:
     """
     Stream a random image from a list of URLs to the client.
-    Handles retries if an image fails to stream.
+    If an image fails, several others are tried at once.
     
     Args:
         client_socket: The client socket to stream to
         urls: List of image URLs
         gfx_mode: The graphics mode to use
+        dither: The GRAPHICS_8 dither method
     """
     if not urls:
         send_client_response(client_socket, "No images found", is_error=True)
         return
-        
-    url_idx = random.randint(0, len(urls)-1)
-    url = urls[url_idx]
-    
-    # Loop if we have a problem with the image, selecting the next
-    while not stream_YAI(client_socket, gfx_mode, url=url):
-        logger.warning(f'Problem with {url} trying another...')
-        url_idx = random.randint(0, len(urls)-1)
-        url = urls[url_idx]
-        time.sleep(SOCKET_WAIT_TIME)  # Give some breathing room.  Sleep for a second
 
-def stream_random_image_from_files(client_socket: socket.socket, gfx_mode: int) -> None:
+    image_yai = race_for_frame(urls, lambda url: encode_source(download_image(url), gfx_mode, dither))
+    if image_yai is None:
+        send_client_response(client_socket, "Could not load any of the images found", is_error=True)
+        return
+
+    client_socket.sendall(image_yai)
+
+def encode_random_url(urls: List[str], gfx_mode: int, dither: str = DEFAULT_DITHER) -> Optional[bytes]:
+    """
+    Download and encode a random image from a list of URLs, for the prefetcher.
+
+    Returns:
+        The YAI payload, or None if the image could not be used
+    """
+    picked = pick_candidates(urls, 1, set())
+    if not picked:
+        return None
+
+    url = picked[0]
+    try:
+        return encode_source(download_image(url), gfx_mode, dither)
+    except Exception as e:
+        logger.warning(f'Problem prefetching {url}: {e}')
+        record_failure(url, e)
+        return None
+
+def stream_random_image_from_files(client_socket: socket.socket, gfx_mode: int, dither: str = DEFAULT_DITHER) -> None:
     """
     Stream a random image from the loaded filenames to the client.
-    Handles retries if an image fails to stream.
+    If an image fails, several others are tried at once.
     
     Args:
         client_socket: The client socket to stream to
         gfx_mode: The graphics mode to use
+        dither: The GRAPHICS_8 dither method
     """
-    if not filenames:
+    # Pre-encoded .YAI files can only be sent to clients in the mode they were encoded for
+    candidates = filenames
+    if yai_file_modes:
+        candidates = [f for f in filenames if yai_file_modes.get(f, gfx_mode) == gfx_mode]
+
+    if not candidates:
         send_client_response(client_socket, "No image files available", is_error=True)
         return
         
-    file_idx = random.randint(0, len(filenames)-1)
-    filename = filenames[file_idx]
-    
-    # Loop if we have a problem with the image, selecting the next
-    while not stream_YAI(client_socket, gfx_mode, filepath=filename):
-        logger.warning(f'Problem with {filename} trying another...')
-        file_idx = random.randint(0, len(filenames)-1)
-        filename = filenames[file_idx]
-        time.sleep(SOCKET_WAIT_TIME)
+    # The first try goes through stream_YAI, which sends pre-encoded files with sendfile
+    picked = pick_candidates(candidates, 1, set())
+    if picked:
+        if stream_YAI(client_socket, gfx_mode, filepath=picked[0], dither=dither):
+            return
+        logger.warning(f'Problem with {picked[0]} trying others...')
+        record_failure(picked[0])
+
+    image_yai = race_for_frame(candidates, lambda filename: load_file_frame(filename, gfx_mode, dither),
+                               set(picked), race_width)
+    if image_yai is None:
+        send_client_response(client_socket, "Could not load any of the image files", is_error=True)
+        return
+
+    client_socket.sendall(image_yai)
 
 def send_client_response(client_socket: socket.socket, message: str, is_error: bool = False) -> None:
     """
@@ -447,7 +1186,7 @@ def send_client_response(client_socket: socket.socket, message: str, is_error: b
     except Exception as e:
         logger.error(f"Failed to send response to client: {e}")
 
-def stream_generated_image(client_socket: socket.socket, prompt: str, gfx_mode: int) -> None:
+def stream_generated_image(client_socket: socket.socket, prompt: str, gfx_mode: int, dither: str = DEFAULT_DITHER) -> None:
     """
     Generate an image with the configured model and stream it to the client.
     
@@ -455,29 +1194,31 @@ def stream_generated_image(client_socket: socket.socket, prompt: str, gfx_mode:
         client_socket: The client socket to stream to
         prompt: The text prompt for image generation
         gfx_mode: The graphics mode to use
+        dither: The GRAPHICS_8 dither method
     """
     logger.info(f"Generating image with prompt: '{prompt}'")
     
     # Generate image using the configured model
-    url_or_path = generate_image(prompt)
+    with admission.work('generate'):
+        url_or_path = generate_image(prompt)
     
     if url_or_path:
         # Stream the generated image to the client
         if url_or_path.startswith('http'):
             # It's a URL (from OpenAI)
-            if not stream_YAI(client_socket, gfx_mode, url=url_or_path):
+            if not stream_YAI(client_socket, gfx_mode, url=url_or_path, dither=dither):
                 logger.warning(f'Problem with generated image: {url_or_path}')
                 send_client_response(client_socket, "Failed to stream generated image", is_error=True)
         else:
             # It's a local file path (from Gemini)
-            if not stream_YAI(client_socket, gfx_mode, filepath=url_or_path):
+            if not stream_YAI(client_socket, gfx_mode, filepath=url_or_path, dither=dither):
                 logger.warning(f'Problem with generated image: {url_or_path}')
                 send_client_response(client_socket, "Failed to stream generated image", is_error=True)
     else:
         logger.warning('Failed to generate image')
         send_client_response(client_socket, "Failed to generate image", is_error=True)
 
-def stream_generated_image_gemini(client_socket: socket.socket, prompt: str, gfx_mode: int) -> None:
+def stream_generated_image_gemini(client_socket: socket.socket, prompt: str, gfx_mode: int, dither: str = DEFAULT_DITHER) -> None:
     """
     Generate an image with Gemini and stream it to the client.
     
@@ -485,33 +1226,377 @@ def stream_generated_image_gemini(client_socket: socket.socket, prompt: str, gfx
         client_socket: The client socket to stream to
         prompt: The text prompt for image generation
         gfx_mode: The graphics mode to use
+        dither: The GRAPHICS_8 dither method
     """
     logger.info(f"Generating image with prompt: '{prompt}'")
     
     # Generate image using Gemini
-    image_path = generate_image_with_gemini(prompt)
+    with admission.work('generate'):
+        image_path = generate_image_with_gemini(prompt)
     
     if image_path:
         # Stream the generated image to the client
-        if not stream_YAI(client_socket, gfx_mode, filepath=image_path):
+        if not stream_YAI(client_socket, gfx_mode, filepath=image_path, dither=dither):
             logger.warning(f'Problem with generated image: {image_path}')
             send_client_response(client_socket, "Failed to stream generated image", is_error=True)
     else:
         logger.warning('Failed to generate image with Gemini')
         send_client_response(client_socket, "Failed to generate image", is_error=True)
 
-def handle_client_connection(client_socket: socket.socket, thread_id: int) -> None:
+def is_http_request(request: bytes) -> bool:
+    """
+    Check if a client request looks like an HTTP request.
+    """
+    return request.startswith(b'GET') or request.startswith(b'POST') or request.startswith(b'PUT') or request.startswith(b'DELETE') or request.startswith(b'HEAD')
+
+HTTP_FORBIDDEN_RESPONSE = b"HTTP/1.1 403 Forbidden\r\nContent-Type: text/plain\r\nContent-Length: 11\r\n\r\nNot Allowed"
+
+class ClientSession:
+    """
+    The state of one client connection (graphics mode, current command mode,
+    search results and prompt) and the processing of its commands.
+    The same session runs under the threaded and the asyncio servers.
+    """
+
+    def __init__(self, client_socket: socket.socket, thread_id: int):
+        """
+        Args:
+            client_socket: The client socket, or anything with sendall() and sendfile()
+            thread_id: The ID of this client connection for tracking
+        """
+        self.client_socket = client_socket
+        self.raw_socket = client_socket  # client_socket without compression
+        self.thread_id = thread_id
+        self.gfx_mode = GRAPHICS_8
+        self.dither = default_dither
+        self._client_mode = None
+        self.last_prompt = None  # Store the last prompt for regeneration
+        self.urls = []
+        self.search_query = None
+        self.shown = 0  # Search results sent since the search
+        self.prefetcher = None  # Search results fetched ahead of "next"
+        self.video_sequence = None  # Sequence number of the last camera frame sent
+        self.delta_encoder = None   # Reference frame for delta video, if the client asked for it
+        self.done = False
+
+    @property
+    def client_mode(self) -> Optional[str]:
+        return self._client_mode
+
+    @client_mode.setter
+    def client_mode(self, mode: Optional[str]) -> None:
+        """
+        Switch mode, keeping the camera capturing only while the client is in video mode.
+        """
+        if mode == 'video' and self._client_mode != 'video':
+            self.video_sequence = None
+            if self.delta_encoder is not None:
+                self.delta_encoder.reset()
+            attach_camera_client()
+        elif mode != 'video' and self._client_mode == 'video':
+            detach_camera_client()
+        self._client_mode = mode
+
+    def start_prefetch(self) -> None:
+        """
+        Make sure search results are being fetched ahead for the current
+        query, graphics mode and dither method, dropping any queued for
+        different ones.
+        """
+        if prefetch_executor is None or not self.urls:
+            return
+
+        key = (self.search_query, self.gfx_mode, encode_variant(self.gfx_mode, self.dither))
+        if self.prefetcher is None or self.prefetcher.key != key:
+            self.cancel_prefetch()
+            urls, gfx_mode, dither = self.urls, self.gfx_mode, self.dither
+            self.prefetcher = FramePrefetcher(prefetch_executor, lambda: encode_random_url(urls, gfx_mode, dither),
+                                              prefetch_depth, key)
+
+    def count_shown(self) -> None:
+        """
+        Count a search result sent, asking the search for its full results
+        once half of those found so far have been shown.
+        """
+        self.shown += 1
+        if isinstance(self.urls, UrlPool) and self.shown * 2 >= len(self.urls):
+            self.urls.want_more()
+
+    def prefetched_frame(self) -> Optional[bytes]:
+        """
+        The next search result from the prefetch queue.
+
+        Returns:
+            The YAI payload, or None if prefetching is off or every queued attempt failed
+        """
+        self.start_prefetch()
+        if self.prefetcher is None:
+            return None
+        return self.prefetcher.take()
+
+    def send_video_frame(self) -> None:
+        """
+        Send the newest camera frame, shared with every client in the same mode.
+        """
+        key = video_key(self.gfx_mode, self.dither)
+        sequence, vid_frame_yail = video_broadcast.frame(key, self.video_sequence)
+        if vid_frame_yail is None:
+            send_client_response(self.client_socket, "No frame from the camera", is_error=True)
+            return
+        self.video_sequence = sequence
+        if self.delta_encoder is not None:
+            vid_frame_yail = delta_frame(self.delta_encoder, key, vid_frame_yail)
+        self.client_socket.sendall(vid_frame_yail)
+
+    def cancel_prefetch(self) -> None:
+        """
+        Drop any prefetched frames.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+
+    def close(self) -> None:
+        """
+        Release what the session holds when the client disconnects.
+        """
+        self.cancel_prefetch()
+        self.client_mode = None
+
+    def handle_line(self, line: str) -> None:
+        """
+        Process one command line.  A line may hold several commands
+        ("gfx 4 search cats"); search and gen take the rest of the line.
+
+        Args:
+            line: The command line, without its newline
+        """
+        tokens = line.split(' ')
+        while len(tokens) > 0 and not self.done:
+            self.handle_command(tokens, line)
+
+    def handle_command(self, tokens: List[str], r_string: str) -> None:
+        """
+        Process the command at the front of tokens, removing the tokens it uses.
+        If the server is too busy to run it, the client gets an error packet
+        and the rest of the request is dropped.
+
+        Args:
+            tokens: The tokens of the client's request
+            r_string: The request as received, for logging
+        """
+        try:
+            self.run_command(tokens, r_string)
+        except Overloaded as e:
+            tokens.clear()
+            send_client_response(self.client_socket, str(e), is_error=True)
+
+    def run_command(self, tokens: List[str], r_string: str) -> None:
+        """
+        Process the command at the front of tokens, removing the tokens it uses.
+        """
+        logger.info(f'{self.thread_id} Tokens {tokens}')
+
+        if tokens[0] == 'video':
+            self.client_mode = 'video'
+            # Send a single frame from the camera to trigger the "next" response
+            self.send_video_frame()
+            tokens.pop(0)
+
+        elif tokens[0] == 'search':
+            self.client_mode = 'search'
+            # Join all tokens after 'search' as the search term
+            prompt = ' '.join(tokens[1:])
+            logger.info(f"Received search {prompt}")
+            self.cancel_prefetch()
+            self.urls = search_images(prompt)
+            self.search_query = prompt
+            self.shown = 0
+            stream_random_image_from_urls(self.client_socket, self.urls, self.gfx_mode, self.dither)
+            self.count_shown()
+            tokens.clear()
+            self.start_prefetch()
+
+        elif tokens[0][:3] == 'gen':
+            self.client_mode = 'generate'
+            # Join all tokens after 'generate' as the prompt
+            ai_model_name = tokens[1]
+            prompt = ' '.join(tokens[2:])
+            logger.info(f"{self.thread_id} Received {tokens[0]} model={ai_model_name} prompt={prompt}")
+            self.last_prompt = prompt  # Store the prompt for later use with 'next' command
+            stream_generated_image(self.client_socket, prompt, self.gfx_mode, self.dither)
+            tokens.clear()
+
+        elif tokens[0] == 'files':
+            self.client_mode = 'files'
+            stream_random_image_from_files(self.client_socket, self.gfx_mode, self.dither)
+            tokens.pop(0)
+
+        elif tokens[0] == 'next':
+            if self.client_mode == 'search':
+                image_yai = self.prefetched_frame()
+                if image_yai is not None:
+                    self.client_socket.sendall(image_yai)
+                else:
+                    stream_random_image_from_urls(self.client_socket, self.urls, self.gfx_mode, self.dither)
+                self.count_shown()
+                tokens.pop(0)
+            elif self.client_mode == 'video':
+                self.send_video_frame()
+                tokens.pop(0)
+            elif self.client_mode == 'generate':
+                # For generate mode, we'll regenerate with the same prompt
+                # The prompt is stored in self.last_prompt
+                prompt = self.last_prompt
+                logger.info(f"{self.thread_id} Regenerating image with prompt: '{prompt}'")
+                stream_generated_image(self.client_socket, prompt, self.gfx_mode, self.dither)
+                tokens.pop(0)
+            elif self.client_mode == 'files':
+                stream_random_image_from_files(self.client_socket, self.gfx_mode, self.dither)
+                tokens.pop(0)
+            else:
+                send_client_response(self.client_socket, "No previous command to repeat", is_error=True)
+                tokens.pop(0)
+
+        elif tokens[0] == 'gfx':
+            tokens.pop(0)
+            gfx_mode = int(tokens[0])
+            if gfx_mode != self.gfx_mode:
+                self.cancel_prefetch()  # prefetched frames are for the old mode
+            self.gfx_mode = gfx_mode
+            #if gfx_mode > GRAPHICS_9:  # VBXE
+            #    global YAIL_H
+            #    YAIL_H = 240
+            tokens.pop(0)
+
+        elif tokens[0] == 'dither':
+            tokens.pop(0)
+            if len(tokens) > 0:
+                if tokens[0] in DITHER_METHODS:
+                    self.dither = tokens[0]
+                else:
+                    logger.warning(f"{self.thread_id} Unknown dither method '{tokens[0]}', keeping {self.dither}")
+                tokens.pop(0)
+
+        elif tokens[0] == 'delta':
+            # Video frames as changes against the previous one: delta on|off
+            tokens.pop(0)
+            if len(tokens) > 0:
+                if tokens[0] == 'on':
+                    if self.delta_encoder is None:
+                        self.delta_encoder = DeltaEncoder(keyframe_interval)
+                elif tokens[0] == 'off':
+                    self.delta_encoder = None
+                else:
+                    logger.warning(f"{self.thread_id} Unknown delta setting '{tokens[0]}', use 'on' or 'off'")
+                tokens.pop(0)
+
+        elif tokens[0] == 'compress':
+            # Image blocks compressed when that makes them smaller: compress rle|off
+            tokens.pop(0)
+            if len(tokens) > 0:
+                if tokens[0] == 'rle':
+                    self.client_socket = CompressingSocket(self.raw_socket, compress_frame)
+                elif tokens[0] == 'off':
+                    self.client_socket = self.raw_socket
+                else:
+                    logger.warning(f"{self.thread_id} Unknown compression '{tokens[0]}', use 'rle' or 'off'")
+                tokens.pop(0)
+
+        elif tokens[0] == 'keyframe':
+            # The next video frame is sent in full
+            if self.delta_encoder is not None:
+                self.delta_encoder.reset()
+            tokens.pop(0)
+
+        elif tokens[0] == 'openai-config':
+            tokens.pop(0)
+            if len(tokens) > 0:
+                # Process OpenAI configuration parameters
+                
+                # Format: openai-config [param] [value]
+                param = tokens[0].lower()
+                tokens.pop(0)
+                
+                if len(tokens) > 0:
+                    value = tokens[0]
+                    tokens.pop(0)
+                    
+                    if param == "model":
+                        if gen_config.set_model(value):
+                            send_client_response(self.client_socket, f"OpenAI model set to {value}")
+                        else:
+                            send_client_response(self.client_socket, "Invalid model. Use 'dall-e-3' or 'dall-e-2'", is_error=True)
+                    
+                    elif param == "size":
+                        if gen_config.set_size(value):
+                            send_client_response(self.client_socket, f"Image size set to {value}")
+                        else:
+                            send_client_response(self.client_socket, "Invalid size. Use '1024x1024', '1792x1024', or '1024x1792'", is_error=True)
+                    
+                    elif param == "quality":
+                        if gen_config.set_quality(value):
+                            send_client_response(self.client_socket, f"Image quality set to {value}")
+                        else:
+                            send_client_response(self.client_socket, "Invalid quality. Use 'standard' or 'hd'", is_error=True)
+                    
+                    elif param == "style":
+                        if gen_config.set_style(value):
+                            send_client_response(self.client_socket, f"Image style set to {value}")
+                        else:
+                            send_client_response(self.client_socket, "Invalid style. Use 'vivid' or 'natural'", is_error=True)
+                    
+                    elif param == "system_prompt":
+                        if gen_config.set_system_prompt(value):
+                            send_client_response(self.client_socket, f"System prompt set to {value}")
+                        else:
+                            send_client_response(self.client_socket, "Failed to set system prompt", is_error=True)
+                    
+                    else:
+                        send_client_response(self.client_socket, f"Unknown parameter '{param}'. Use 'model', 'size', 'quality', 'style', or 'system_prompt'", is_error=True)
+                else:
+                    send_client_response(self.client_socket, f"Current OpenAI config: {gen_config}")
+            else:
+                send_client_response(self.client_socket, f"Current OpenAI config: {gen_config}")
+
+        elif tokens[0] == 'gen':
+            self.client_mode = 'generate'
+            # Join all tokens after 'gen' as the prompt
+            prompt = ' '.join(tokens[1:])
+            logger.info(f"{self.thread_id} Received gen {prompt}")
+            self.last_prompt = prompt  # Store the prompt for later use with 'next' command
+            stream_generated_image(self.client_socket, prompt, self.gfx_mode, self.dither)
+            tokens.clear()
+
+        elif tokens[0] == 'gen-gemini':
+            self.client_mode = 'generate'
+            # Join all tokens after 'gen-gemini' as the prompt
+            prompt = ' '.join(tokens[1:])
+            logger.info(f"{self.thread_id} Received gen-gemini {prompt}")
+            self.last_prompt = prompt  # Store the prompt for later use with 'next' command
+            stream_generated_image_gemini(self.client_socket, prompt, self.gfx_mode, self.dither)
+            tokens.clear()
+
+        elif tokens[0] == 'quit':
+            self.done = True
+            tokens.pop(0)
+
+        else:
+            tokens.clear() # reset tokens if unrecognized command
+            r_string = r_string.rstrip(" \r\n")   # strip whitespace
+            logger.info(f'{self.thread_id} Received {r_string}')
+            send_client_response(self.client_socket, "ACK!")
+
+
+def handle_client_connection(client_socket: socket.socket, thread_id: int, client_ip: str = None) -> None:
     """
     Handle a client connection in a separate thread.
     
     Args:
         client_socket: The client socket to handle
         thread_id: The ID of this client thread for tracking
+        client_ip: The client's address, if it was admitted with admission.connect()
     """
-    global active_client_threads
-    global last_prompt
-    global last_gen_model
-    global gen_config
     global connections
     
     logger.info(f"Starting Connection: {thread_id}")
@@ -519,172 +1604,46 @@ def handle_client_connection(client_socket: socket.socket, thread_id: int) -> No
     connections += 1
     logger.info(f'Starting Connection: {connections}')
     
-    gfx_mode = GRAPHICS_8
-    client_mode = None
-    last_prompt = None  # Store the last prompt for regeneration
+    writer = None
+    session = None
 
     try:
-        client_socket.settimeout(300)  # 5 minutes timeout
-        done = False
-        urls = []
-        url_idx = 0
-        tokens = []
-        while not done:
-            if len(tokens) == 0:
+        client_socket.settimeout(CLIENT_TIMEOUT)
+        tune_socket(client_socket, so_sndbuf)
+        if send_pump is not None:
+            writer = ClientWriter(client_socket, send_pump, send_buffer_bytes, CLIENT_TIMEOUT)
+        session = ClientSession(writer or client_socket, thread_id)
+        parser = CommandParser()
+
+        while not session.done:
+            client_socket.settimeout(PARTIAL_LINE_TIMEOUT if parser.pending else CLIENT_TIMEOUT)
+            try:
                 request = client_socket.recv(1024)
+            except socket.timeout:
+                if not parser.pending:
+                    raise
+                # Older clients do not end their commands with a newline
+                line = parser.flush()
+                lines = [line] if line else []
+            else:
                 logger.info(f'{thread_id} Client request {request}')
-                
+                if not request:
+                    break  # the client closed the connection
+
                 # Check if this looks like an HTTP request
-                if request.startswith(b'GET') or request.startswith(b'POST') or request.startswith(b'PUT') or request.startswith(b'DELETE') or request.startswith(b'HEAD'):
+                if not parser.pending and is_http_request(request):
                     logger.warning("HTTP request detected - sending 'Not Allowed' response")
-                    http_response = "HTTP/1.1 403 Forbidden\r\nContent-Type: text/plain\r\nContent-Length: 11\r\n\r\nNot Allowed"
-                    client_socket.sendall(http_response.encode('utf-8'))
+                    client_socket.sendall(HTTP_FORBIDDEN_RESPONSE)
                     break
-                
-                r_string = request.decode('UTF-8')
-                tokens = r_string.rstrip(' \r\n').split(' ')
-            logger.info(f'{thread_id} Tokens {tokens}')
-
-            if tokens[0] == 'video':
-                client_mode = 'video'
-                # Send a single frame from the camera to trigger the "next" response
-                vid_frame = capture_camera_image(YAIL_W, YAIL_H)
-                vid_frame_yail = convertImageToYAIL(vid_frame, gfx_mode)
-                client_socket.sendall(vid_frame_yail)
-                tokens.pop(0)
 
-            elif tokens[0] == 'search':
-                client_mode = 'search'
-                # Join all tokens after 'search' as the search term
-                prompt = ' '.join(tokens[1:])
-                logger.info(f"Received search {prompt}")
-                urls = search_images(prompt)
-                stream_random_image_from_urls(client_socket, urls, gfx_mode)
-                tokens = []
-
-            elif tokens[0][:3] == 'gen':
-                client_mode = 'generate'
-                # Join all tokens after 'generate' as the prompt
-                ai_model_name = tokens[1]
-                prompt = ' '.join(tokens[2:])
-                logger.info(f"{thread_id} Received {tokens[0]} model={ai_model_name} prompt={prompt}")
-                last_prompt = prompt  # Store the prompt for later use with 'next' command
-                stream_generated_image(client_socket, prompt, gfx_mode)
-                tokens = []
-
-            elif tokens[0] == 'files':
-                client_mode = 'files'
-                stream_random_image_from_files(client_socket, gfx_mode)
-                tokens.pop(0)
+                lines = parser.feed(request)
 
-            elif tokens[0] == 'next':
-                if client_mode == 'search':
-                    stream_random_image_from_urls(client_socket, urls, gfx_mode)
-                    tokens.pop(0)
-                elif client_mode == 'video':
-                    vid_frame = capture_camera_image(YAIL_W, YAIL_H)
-                    vid_frame_yail = convertImageToYAIL(vid_frame, gfx_mode)
-                    client_socket.sendall(vid_frame_yail)
-                    #send_yail_data(client_socket)
-                    tokens.pop(0)
-                elif client_mode == 'generate':
-                    # For generate mode, we'll regenerate with the same prompt
-                    # The prompt is stored in last_prompt
-                    prompt = last_prompt
-                    logger.info(f"{thread_id} Regenerating image with prompt: '{prompt}'")
-                    stream_generated_image(client_socket, prompt, gfx_mode)
-                    tokens.pop(0)
-                elif client_mode == 'files':
-                    stream_random_image_from_files(client_socket, gfx_mode)
-                    tokens.pop(0)
-                else:
-                    send_client_response(client_socket, "No previous command to repeat", is_error=True)
-
-            elif tokens[0] == 'gfx':
-                tokens.pop(0)
-                gfx_mode = int(tokens[0])
-                #if gfx_mode > GRAPHICS_9:  # VBXE
-                #    global YAIL_H
-                #    YAIL_H = 240
-                tokens.pop(0)
-
-            elif tokens[0] == 'openai-config':
-                tokens.pop(0)
-                if len(tokens) > 0:
-                    # Process OpenAI configuration parameters
-                    
-                    # Format: openai-config [param] [value]
-                    param = tokens[0].lower()
-                    tokens.pop(0)
-                    
-                    if len(tokens) > 0:
-                        value = tokens[0]
-                        tokens.pop(0)
-                        
-                        if param == "model":
-                            if gen_config.set_model(value):
-                                send_client_response(client_socket, f"OpenAI model set to {value}")
-                            else:
-                                send_client_response(client_socket, "Invalid model. Use 'dall-e-3' or 'dall-e-2'", is_error=True)
-                        
-                        elif param == "size":
-                            if gen_config.set_size(value):
-                                send_client_response(client_socket, f"Image size set to {value}")
-                            else:
-                                send_client_response(client_socket, "Invalid size. Use '1024x1024', '1792x1024', or '1024x1792'", is_error=True)
-                        
-                        elif param == "quality":
-                            if gen_config.set_quality(value):
-                                send_client_response(client_socket, f"Image quality set to {value}")
-                            else:
-                                send_client_response(client_socket, "Invalid quality. Use 'standard' or 'hd'", is_error=True)
-                        
-                        elif param == "style":
-                            if gen_config.set_style(value):
-                                send_client_response(client_socket, f"Image style set to {value}")
-                            else:
-                                send_client_response(client_socket, "Invalid style. Use 'vivid' or 'natural'", is_error=True)
-                        
-                        elif param == "system_prompt":
-                            if gen_config.set_system_prompt(value):
-                                send_client_response(client_socket, f"System prompt set to {value}")
-                            else:
-                                send_client_response(client_socket, "Failed to set system prompt", is_error=True)
-                        
-                        else:
-                            send_client_response(client_socket, f"Unknown parameter '{param}'. Use 'model', 'size', 'quality', 'style', or 'system_prompt'", is_error=True)
-                    else:
-                        send_client_response(client_socket, f"Current OpenAI config: {gen_config}")
-                else:
-                    send_client_response(client_socket, f"Current OpenAI config: {gen_config}")
-
-            elif tokens[0] == 'gen':
-                client_mode = 'generate'
-                # Join all tokens after 'gen' as the prompt
-                prompt = ' '.join(tokens[1:])
-                logger.info(f"{thread_id} Received gen {prompt}")
-                last_prompt = prompt  # Store the prompt for later use with 'next' command
-                stream_generated_image(client_socket, prompt, gfx_mode)
-                tokens = []
-
-            elif tokens[0] == 'gen-gemini':
-                client_mode = 'generate'
-                # Join all tokens after 'gen-gemini' as the prompt
-                prompt = ' '.join(tokens[1:])
-                logger.info(f"{thread_id} Received gen-gemini {prompt}")
-                last_prompt = prompt  # Store the prompt for later use with 'next' command
-                stream_generated_image_gemini(client_socket, prompt, gfx_mode)
-                tokens = []
-
-            elif tokens[0] == 'quit':
-                done = True
-                tokens.pop(0)
-
-            else:
-                tokens = [] # reset tokens if unrecognized command
-                r_string = r_string.rstrip(" \r\n")   # strip whitespace
-                logger.info(f'{thread_id} Received {r_string}')
-                send_client_response(client_socket, "ACK!")
+            # Commands run, and send their frames, under the full timeout
+            client_socket.settimeout(CLIENT_TIMEOUT)
+            for line in lines:
+                if session.done:
+                    break
+                session.handle_line(line)
 
     except socket.timeout:
         logger.warning(f"Client connection {thread_id} timed out")
@@ -698,8 +1657,14 @@ def handle_client_connection(client_socket: socket.socket, thread_id: int) -> No
     finally:
         # Clean up resources
         try:
+            if session is not None:
+                session.close()
+            if writer is not None:
+                writer.close()
             client_socket.close()
             logger.info(f"Closing Connection: {thread_id}")
+            if client_ip is not None:
+                admission.disconnect(client_ip)
             
             # Update connection counter
             connections -= 1
@@ -710,6 +1675,117 @@ def handle_client_connection(client_socket: socket.socket, thread_id: int) -> No
 
     logger.debug(f"handle_client_connection thread exiting: {threading.get_native_id()}")
 
+connection_ids = itertools.count(1)  # IDs for asyncio connections
+
+async def handle_client_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                              executor: ThreadPoolExecutor) -> None:
+    """
+    Handle a client connection on the event loop.  Waiting for the client's
+    next request costs no thread; each command runs on the executor.
+
+    Args:
+        reader: The client's stream reader
+        writer: The client's stream writer
+        executor: The thread pool that runs the commands
+    """
+    global connections
+
+    loop = asyncio.get_running_loop()
+    thread_id = next(connection_ids)
+    address = writer.get_extra_info('peername')
+    logger.info(f'Accepted connection from {address[0]}:{address[1]}')
+    if not admission.connect(address[0]):
+        writer.write(createErrorPacket(b'Server busy: too many connections', GRAPHICS_8))
+        await writer.drain()
+        writer.close()
+        return
+    logger.info(f"Starting Connection: {thread_id}")
+
+    connections += 1
+    logger.info(f'Starting Connection: {connections}')
+
+    # The transport buffers up to send_buffer_bytes before sendall() waits for the client
+    tune_socket(writer.get_extra_info('socket'), so_sndbuf)
+    writer.transport.set_write_buffer_limits(high=send_buffer_bytes)
+    session = ClientSession(AsyncClientSocket(writer, loop, CLIENT_TIMEOUT), thread_id)
+    parser = CommandParser()
+
+    try:
+        while not session.done:
+            try:
+                request = await asyncio.wait_for(reader.read(1024), PARTIAL_LINE_TIMEOUT if parser.pending else CLIENT_TIMEOUT)
+            except asyncio.TimeoutError:
+                if not parser.pending:
+                    raise
+                # Older clients do not end their commands with a newline
+                line = parser.flush()
+                lines = [line] if line else []
+            else:
+                logger.info(f'{thread_id} Client request {request}')
+                if not request:
+                    break  # the client closed the connection
+
+                # Check if this looks like an HTTP request
+                if not parser.pending and is_http_request(request):
+                    logger.warning("HTTP request detected - sending 'Not Allowed' response")
+                    writer.write(HTTP_FORBIDDEN_RESPONSE)
+                    await writer.drain()
+                    break
+
+                lines = parser.feed(request)
+
+            for line in lines:
+                if session.done:
+                    break
+                await loop.run_in_executor(executor, session.handle_line, line)
+
+    except asyncio.TimeoutError:
+        logger.warning(f"Client connection {thread_id} timed out")
+    except ConnectionResetError:
+        logger.warning(f"Client connection {thread_id} was reset by the client")
+    except BrokenPipeError:
+        logger.warning(f"Client connection {thread_id} has a broken pipe")
+    except Exception as e:
+        logger.error(f"Error handling client connection {thread_id}: {e}")
+        logger.error(traceback.format_exc())
+    finally:
+        # Clean up resources
+        try:
+            session.close()
+            writer.close()
+            logger.info(f"Closing Connection: {thread_id}")
+            admission.disconnect(address[0])
+
+            # Update connection counter
+            connections -= 1
+            logger.info(f"Active connections: {connections}")
+
+        except Exception as e:
+            logger.error(f"Error closing client socket for connection {thread_id}: {e}")
+
+async def serve_async(server: socket.socket, workers: int) -> None:
+    """
+    Serve clients from an already listening socket with asyncio, until
+    SIGINT or SIGTERM.
+
+    Args:
+        server: The bound, listening server socket
+        workers: Number of threads that run client commands
+    """
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='yail-command')
+    async_server = await asyncio.start_server(lambda reader, writer: handle_client_async(reader, writer, executor),
+                                              sock=server)
+    logger.info(f'Serving clients with asyncio and {workers} command threads')
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with async_server:
+        await stop.wait()
+    executor.shutdown(wait=False, cancel_futures=True)
+
 def process_files(input_path: Union[str, List[str]], 
                   extensions: List[str], 
                   F: Callable[[str], None]) -> None:
@@ -733,6 +1809,12 @@ def process_files(input_path: Union[str, List[str]],
 def F(file_path):
     global filenames
     logger.info(f"Processing file: {file_path}")
+    if file_path.lower().endswith(YAI_EXTENSION):
+        gfx_mode = read_yai_file_mode(file_path)
+        if gfx_mode is None:
+            logger.warning(f"Skipping invalid YAI file: {file_path}")
+            return
+        yai_file_modes[file_path] = gfx_mode
     filenames.append(file_path)
 
 def main():
@@ -741,6 +1823,28 @@ def main():
     """
     global active_client_threads
     global gen_config
+    global library
+    global encoder_pool
+    global default_dither
+    global vbxe_video_palette
+    global max_image_pixels
+    global max_download_bytes
+    global http_session
+    global http_timeout
+    global video_broadcast
+    global keyframe_interval
+    global admission
+    global send_pump
+    global send_buffer_bytes
+    global so_sndbuf
+    global prefetch_executor
+    global prefetch_depth
+    global race_executor
+    global race_width
+    global failure_cache
+    global source_cache
+    global search_cache
+    global search_cache_file
     
     # Track active client threads
     active_threads = []
@@ -751,6 +1855,39 @@ def main():
         
         # Stop the camera thread if it's running
         shutdown_camera()
+
+        logger.info(f"Frame cache: {frame_cache.stats()}")
+        logger.info(f"Search cache: {search_cache.stats()}")
+        if source_cache is not None:
+            logger.info(f"Source cache: {source_cache.stats()}")
+        if video_broadcast is not None:
+            logger.info(f"Video broadcast: {video_broadcast.stats()}")
+        logger.info(f"Compression: {compression_stats.stats()}")
+
+        if search_cache_file:
+            try:
+                search_cache.save(search_cache_file)
+            except OSError as e:
+                logger.error(f"Error saving the search cache: {e}")
+        logger.info(f"Admission: {admission.stats()}")
+
+        if encoder_pool is not None:
+            encoder_pool.shutdown()
+
+        if send_pump is not None:
+            send_pump.stop()
+
+        if prefetch_executor is not None:
+            prefetch_executor.shutdown(wait=False, cancel_futures=True)
+
+        if race_executor is not None:
+            race_executor.shutdown(wait=False, cancel_futures=True)
+
+        http_session.close()
+
+        if library is not None:
+            library.stop()
+            logger.info(f"Library: {library.hits} hits, {library.misses} misses")
         
         # Close the server socket
         if 'server' in locals():
@@ -773,10 +1910,7 @@ def main():
     # Register signal handlers
     signal.signal(signal.SIGINT, signal_handler)   # Ctrl+C
     signal.signal(signal.SIGTERM, signal_handler)  # Termination signal
-    
-    # Initialize the image object to send with something
-    initial_image = convertImageToYAIL(Image.new("L", (YAIL_W,YAIL_H)), GRAPHICS_8)
-    update_yail_data(initial_image, GRAPHICS_8) #pack_shades(initial_image), GRAPHICS_8)
+
 
     bind_ip = '0.0.0.0'
     bind_port = 5556
@@ -784,7 +1918,7 @@ def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='YAIL Server')
     parser.add_argument('--paths', nargs='*', help='Directory containing images to stream')
-    parser.add_argument('--extensions', nargs='*', default=['.jpg', '.jpeg', '.gif', '.png'], help='File extensions to include')
+    parser.add_argument('--extensions', nargs='*', default=['.jpg', '.jpeg', '.gif', '.png', YAI_EXTENSION], help='File extensions to include')
     parser.add_argument('--camera', nargs='?', help='Camera device to use')
     parser.add_argument('--port', nargs=1, help='Port to listen on')
     parser.add_argument('--loglevel', nargs=1, help='Logging level')
@@ -793,6 +1927,41 @@ def main():
     parser.add_argument('--openai-size', nargs=1, help='Image size for DALL-E models (1024x1024, 1792x1024, or 1024x1792)')
     parser.add_argument('--openai-quality', nargs=1, help='Image quality for DALL-E models (standard or hd)')
     parser.add_argument('--openai-style', nargs=1, help='Image style for DALL-E models (vivid or natural)')
+    parser.add_argument('--library', help='Directory for pre-encoded packs of the --paths images (enables the library)')
+    parser.add_argument('--library-modes', nargs='*', type=int, default=[GRAPHICS_8, GRAPHICS_9, VBXE], help='Graphics modes to pre-encode the library for')
+    parser.add_argument('--library-rescan', type=int, default=DEFAULT_RESCAN_SECONDS, help='Seconds between checks of the library sources for changes')
+    parser.add_argument('--dither', choices=DITHER_METHODS, default=DEFAULT_DITHER, help='Default GRAPHICS_8 dither method')
+    parser.add_argument('--vbxe-video-palette', choices=VBXE_PALETTE_MODES, default=DEFAULT_VBXE_PALETTE, help='VBXE palette for camera frames: adaptive (median cut per frame), fixed, or tracking (re-derived every few frames)')
+    parser.add_argument('--max-image-pixels', type=int, default=DEFAULT_MAX_IMAGE_PIXELS, help='Reject source images with more pixels than this')
+    parser.add_argument('--max-download-mb', type=int, default=DEFAULT_MAX_DOWNLOAD_BYTES // (1024 * 1024), help='Abandon image downloads larger than this many MB')
+    parser.add_argument('--http-pool-hosts', type=int, default=DEFAULT_POOL_HOSTS, help='Image hosts whose connections are kept alive')
+    parser.add_argument('--http-connections-per-host', type=int, default=DEFAULT_CONNECTIONS_PER_HOST, help='Idle connections kept alive per image host')
+    parser.add_argument('--http-connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, help='Seconds to wait for an image host to accept a connection')
+    parser.add_argument('--http-read-timeout', type=float, default=DEFAULT_READ_TIMEOUT, help='Seconds to wait for data from an image host')
+    parser.add_argument('--encoder-workers', type=int, default=0, help='Worker processes for image conversion (0 converts on the client thread)')
+    parser.add_argument('--server', choices=['threads', 'asyncio'], default='threads', help='Serve clients with a thread each or with one asyncio event loop')
+    parser.add_argument('--async-workers', type=int, default=DEFAULT_ASYNC_WORKERS, help='Threads that run client commands in asyncio mode')
+    parser.add_argument('--max-connections', type=int, default=0, help='Client connections open at once (0 is unlimited)')
+    parser.add_argument('--max-connections-per-ip', type=int, default=0, help='Client connections open at once from one IP address (0 is unlimited)')
+    parser.add_argument('--max-searches', type=int, default=0, help='Image searches running at once (0 is unlimited)')
+    parser.add_argument('--max-downloads', type=int, default=0, help='Image downloads running at once (0 is unlimited)')
+    parser.add_argument('--max-converts', type=int, default=DEFAULT_MAX_CONVERTS, help='Image conversions running at once; more wait in the queue (0 is unlimited)')
+    parser.add_argument('--max-generates', type=int, default=0, help='Image generations running at once (0 is unlimited)')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help='Requests of each kind that may wait for a free slot before clients are told the server is busy')
+    parser.add_argument('--queue-timeout', type=float, default=DEFAULT_QUEUE_TIMEOUT, help='Seconds a request may wait for a free slot before the client is told the server is busy')
+    parser.add_argument('--send-buffer-kb', type=int, default=DEFAULT_SEND_BUFFER // 1024, help='Outbound buffer per client in KB, so slow clients do not hold up their handler (0 sends directly)')
+    parser.add_argument('--so-sndbuf-kb', type=int, default=0, help='Kernel send buffer per client socket in KB (0 keeps the system default)')
+    parser.add_argument('--prefetch-depth', type=int, default=DEFAULT_PREFETCH_DEPTH, help='Search results each client keeps downloaded and encoded ahead of "next" (0 disables)')
+    parser.add_argument('--prefetch-workers', type=int, default=DEFAULT_PREFETCH_WORKERS, help='Threads that prefetch search results for all clients')
+    parser.add_argument('--search-cache-entries', type=int, default=DEFAULT_SEARCH_CACHE_ENTRIES, help='Search queries whose results are cached for all clients (0 disables)')
+    parser.add_argument('--search-cache-ttl', type=int, default=DEFAULT_SEARCH_CACHE_TTL, help='Seconds cached search results stay fresh')
+    parser.add_argument('--search-cache-file', help='JSON file the search cache is loaded from at startup and saved to at shutdown')
+    parser.add_argument('--race-width', type=int, default=DEFAULT_RACE_WIDTH, help='Candidate images tried at once after an image fails (1 tries them one at a time)')
+    parser.add_argument('--failure-ttl', type=int, default=DEFAULT_FAILURE_TTL, help='Seconds a failed image URL, host or file is skipped by all clients (0 disables)')
+    parser.add_argument('--source-cache', help='Directory for a disk cache of downloaded source images (enables the cache)')
+    parser.add_argument('--source-cache-mb', type=int, default=DEFAULT_SOURCE_CACHE_BYTES // (1024 * 1024), help='Disk space for cached source images in MB')
+    parser.add_argument('--frame-cache-mb', type=int, default=DEFAULT_FRAME_CACHE_BYTES // (1024 * 1024), help='Memory for cached encoded frames in MB (0 disables)')
+    parser.add_argument('--keyframe-interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL, help='Delta video frames sent between full frames')
     args = parser.parse_args()
 
     if args:
@@ -807,6 +1976,47 @@ def main():
             logger.info("Processing specific files in list:")
             process_files(file_list, args.extensions, F)
 
+        frame_cache.max_bytes = args.frame_cache_mb * 1024 * 1024
+        search_cache = SearchCache(args.search_cache_entries, args.search_cache_ttl)
+        search_cache_file = args.search_cache_file
+        if search_cache_file:
+            search_cache.load(search_cache_file)
+        send_buffer_bytes = args.send_buffer_kb * 1024
+        so_sndbuf = args.so_sndbuf_kb * 1024
+        prefetch_depth = args.prefetch_depth
+
+        race_width = args.race_width
+        failure_cache = FailureCache(args.failure_ttl)
+
+        if args.source_cache:
+            source_cache = SourceCache(args.source_cache, args.source_cache_mb * 1024 * 1024)
+
+        if race_width > 1:
+            race_executor = ThreadPoolExecutor(max_workers=4 * race_width, thread_name_prefix='yail-race')
+
+        if prefetch_depth > 0:
+            prefetch_executor = ThreadPoolExecutor(max_workers=args.prefetch_workers, thread_name_prefix='yail-prefetch')
+        default_dither = args.dither
+        vbxe_video_palette = args.vbxe_video_palette
+        max_image_pixels = args.max_image_pixels
+        max_download_bytes = args.max_download_mb * 1024 * 1024
+        http_session = create_session(args.http_pool_hosts, args.http_connections_per_host)
+        http_timeout = (args.http_connect_timeout, args.http_read_timeout)
+        video_broadcast = FrameBroadcast(latest_camera_frame, encode_video_frame)
+        keyframe_interval = args.keyframe_interval
+        admission = AdmissionControl(args.max_connections, args.max_connections_per_ip,
+                                     {'search': args.max_searches, 'download': args.max_downloads,
+                                      'convert': args.max_converts, 'generate': args.max_generates},
+                                     args.queue_size, args.queue_timeout)
+
+        if args.encoder_workers > 0:
+            encoder_pool = EncoderPool(args.encoder_workers, max_image_pixels)
+
+        if args.library and filenames:
+            sources = [f for f in filenames if f not in yai_file_modes]  # .YAI files are already encoded
+            library = YaiLibrary(args.library, sources, args.library_modes, encode_file, args.library_rescan)
+            library.start()
+
         if args.loglevel:
             loglevel = args.loglevel[0].upper()
             if loglevel == 'DEBUG':
@@ -965,6 +2175,14 @@ def main():
         # Try to initialize the default camera
         init_camera()
 
+    if args.server == 'asyncio':
+        asyncio.run(serve_async(server, args.async_workers))
+        signal_handler(signal.SIGTERM, None)
+
+    if send_buffer_bytes > 0:
+        send_pump = SendPump()
+        send_pump.start()
+
     while True:
         # Clean up finished threads from the active_threads list
         active_threads[:] = [t for t in active_threads if t.is_alive()]
@@ -972,9 +2190,16 @@ def main():
         # Accept new client connections
         client_sock, address = server.accept()
         logger.info(f'Accepted connection from {address[0]}:{address[1]}')
+        if not admission.connect(address[0]):
+            try:
+                client_sock.sendall(createErrorPacket(b'Server busy: too many connections', GRAPHICS_8))
+            except OSError:
+                pass
+            client_sock.close()
+            continue
         client_handler = Thread(
             target=handle_client_connection,
-            args=(client_sock, len(active_threads) + 1)  # thread_id is 1-based
+            args=(client_sock, len(active_threads) + 1, address[0])  # thread_id is 1-based
         )
         client_handler.daemon = True
         client_handler.start()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+YAIL Admission Control Module
+
+This module limits how much work the YAIL server takes on at once: the
+number of client connections in total and per IP address, and the number of
+heavy operations (search, download, convert, generate) running at the same
+time.  Operations over their limit wait in a bounded queue; once the queue
+is full, or a wait takes too long, Overloaded is raised and the client is
+told the server is busy.
+"""
+
+import os
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+WORK_KINDS = ('search', 'download', 'convert', 'generate')
+DEFAULT_QUEUE_SIZE = 128      # Operations of one kind waiting for a slot
+DEFAULT_QUEUE_TIMEOUT = 60.0  # Seconds an operation may wait for a slot
+# Conversions running at once by default.  Two per CPU keep the CPUs busy
+# while conversions wait on decoding and numpy, and the queue absorbs bursts.
+DEFAULT_MAX_CONVERTS = 2 * (os.cpu_count() or 1)
+
+
+class Overloaded(Exception):
+    """
+    Raised when the server cannot take on more work of some kind.
+    """
+
+
+class WorkLimiter:
+    """
+    A counting semaphore with a bounded number of waiters.
+    A limit of 0 means unlimited.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 queue_timeout: float = DEFAULT_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        """
+        Take a slot, waiting in the queue if all slots are in use.
+
+        Raises:
+            Overloaded: If the queue is full or the wait timed out
+        """
+        if self.limit <= 0:
+            return
+
+        with self._cond:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    raise Overloaded(f'Server busy: too many {self.name} requests')
+
+                self.waiting += 1
+                try:
+                    if not self._cond.wait_for(lambda: self.active < self.limit, self.queue_timeout):
+                        self.rejected += 1
+                        raise Overloaded(f'Server busy: timed out waiting to {self.name}')
+                finally:
+                    self.waiting -= 1
+
+            self.active += 1
+
+    def release(self) -> None:
+        """
+        Give back a slot taken with acquire().
+        """
+        if self.limit <= 0:
+            return
+
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the limiter's counters.
+        """
+        with self._cond:
+            return {'limit': self.limit, 'active': self.active, 'waiting': self.waiting, 'rejected': self.rejected}
+
+
+class AdmissionControl:
+    """
+    The server's connection and work limits.  A limit of 0 means unlimited.
+    """
+
+    def __init__(self, max_connections: int = 0, max_connections_per_ip: int = 0,
+                 work_limits: Optional[Dict[str, int]] = None, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 queue_timeout: float = DEFAULT_QUEUE_TIMEOUT):
+        """
+        Args:
+            max_connections: Client connections open at once
+            max_connections_per_ip: Client connections open at once from one IP address
+            work_limits: Concurrent operations per kind in WORK_KINDS
+            queue_size: Operations of one kind that may wait for a slot
+            queue_timeout: Seconds an operation may wait for a slot
+        """
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.connections = 0
+        self.rejected_connections = 0
+        self._connections_per_ip = defaultdict(int)
+        self._lock = threading.Lock()
+
+        work_limits = work_limits or {}
+        self.limiters = {kind: WorkLimiter(kind, work_limits.get(kind, 0), queue_size, queue_timeout)
+                         for kind in WORK_KINDS}
+
+    def connect(self, ip: str) -> bool:
+        """
+        Admit a new connection from ip.  Every admitted connection must be
+        followed by disconnect().
+
+        Returns:
+            True if the connection is within the limits
+        """
+        with self._lock:
+            if (self.max_connections > 0 and self.connections >= self.max_connections) or \
+               (self.max_connections_per_ip > 0 and self._connections_per_ip[ip] >= self.max_connections_per_ip):
+                self.rejected_connections += 1
+                logger.warning(f'Rejecting connection from {ip}: {self.connections} open, {self._connections_per_ip[ip]} from this address')
+                return False
+
+            self.connections += 1
+            self._connections_per_ip[ip] += 1
+            return True
+
+    def disconnect(self, ip: str) -> None:
+        """
+        Release a connection admitted with connect().
+        """
+        with self._lock:
+            self.connections -= 1
+            self._connections_per_ip[ip] -= 1
+            if self._connections_per_ip[ip] <= 0:
+                del self._connections_per_ip[ip]
+
+    @contextmanager
+    def work(self, kind: str) -> Iterator[None]:
+        """
+        Run a heavy operation of kind within its limit.
+
+            with admission.work('convert'):
+                ...
+
+        Raises:
+            Overloaded: If the operation could not get a slot
+        """
+        limiter = self.limiters[kind]
+        limiter.acquire()
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Return the connection counts and the counters of each limiter.
+        """
+        with self._lock:
+            stats = {'connections': self.connections, 'rejected_connections': self.rejected_connections}
+        for kind, limiter in self.limiters.items():
+            stats[kind] = limiter.stats()
+        return stats
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+YAIL Asyncio Module
+
+This module contains the pieces of the asyncio server mode.  Client sockets
+are served by one event loop, so an idle connection costs a stream rather
+than an OS thread.  Commands still run as blocking code on a bounded thread
+pool; AsyncClientSocket lets that code write to the asyncio stream.
+"""
+
+import asyncio
+import logging
+import concurrent.futures
+from typing import BinaryIO, Coroutine, Optional, Union
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_ASYNC_WORKERS = 32
+
+
+class AsyncClientSocket:
+    """
+    A socket-like wrapper around an asyncio StreamWriter for code running in
+    an executor thread.  sendall() and sendfile() block the calling thread
+    until the data has been handed to the transport and drained below its
+    high-water mark, never the event loop.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop,
+                 timeout: Optional[float] = None):
+        """
+        Args:
+            writer: The client's stream
+            loop: The event loop serving the stream
+            timeout: Seconds a send may wait for the client before giving up on it
+        """
+        self.writer = writer
+        self.loop = loop
+        self.timeout = timeout
+
+    def _run(self, coro: Coroutine) -> None:
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise asyncio.TimeoutError('Client is not reading')
+
+    async def _sendall(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def _sendfile(self, file: BinaryIO) -> None:
+        await self.writer.drain()
+        await self.loop.sendfile(self.writer.transport, file)
+
+    def sendall(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        """
+        Send all of data to the client.
+        """
+        self._run(self._sendall(data))
+
+    def sendfile(self, file: BinaryIO) -> None:
+        """
+        Send a file to the client, with os.sendfile where the transport allows it.
+        """
+        self._run(self._sendfile(file))
+
+    def close(self) -> None:
+        """
+        Close the stream.  Safe to call from the event loop thread or any other.
+        """
+        self.loop.call_soon_threadsafe(self.writer.close)
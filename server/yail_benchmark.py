@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+YAIL Encoder Benchmark
+
+Times the image conversion pipeline stage by stage (decode, geometry,
+quantize/dither, pack, header) for every graphics mode over a fixed corpus
+of source sizes and formats, plus the images in test_images/.  Results are
+written as JSON and can be compared against a saved baseline, failing when
+a stage or the peak memory has regressed by more than a threshold.
+
+The stages are timed by wrapping the encoder's own stage functions while
+convertImageToYAIL runs, so the timings follow the real pipeline.  Peak
+memory is the growth of the peak resident set size while one conversion
+runs in a fresh process, after a small warm-up conversion there has built
+the one-time lookup tables, so it is the memory that scales with the image.
+
+    python yail_benchmark.py --output bench.json
+    python yail_benchmark.py --baseline bench.json --threshold 0.25 --memory-threshold 0.25
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import functools
+import statistics
+import multiprocessing
+import multiprocessing.forkserver
+from io import BytesIO
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False  # not on Windows; peak memory is not measured there
+
+import yail
+from yail import (
+    GRAPHICS_8,
+    GRAPHICS_9,
+    VBXE,
+    open_source_image,
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+STAGES = ('decode', 'geometry', 'quantize', 'pack', 'header', 'total')
+# The functions in yail that make up each stage of convertImageToYAIL.  GRAPHICS_9 quantizes
+# while packing and the VBXE quantizers yield packed indices, so those stages report 0.
+STAGE_FUNCTIONS = {'geometry': ('fit_gray', 'prep_image_for_vbxe'),
+                   'quantize': ('dither_image', 'quantize_vbxe'),
+                   'pack': ('pack_bits', 'pack_shades'),
+                   'header': ('convertToYai', 'vbxe_packet')}
+MODES = {'gr8': (GRAPHICS_8, 'floyd', 'adaptive'),
+         'gr8-bayer8': (GRAPHICS_8, 'bayer8', 'adaptive'),
+         'gr9': (GRAPHICS_9, 'floyd', 'adaptive'),
+         'vbxe': (VBXE, 'floyd', 'adaptive'),
+         'vbxe-fixed': (VBXE, 'floyd', 'fixed')}
+SIZES = [(320, 220), (1024, 1024), (1792, 1024), (4000, 3000)]
+FORMATS = ['JPEG', 'PNG', 'GIF']
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.25     # Fail when a stage is more than 25% slower...
+DEFAULT_MIN_DELTA_MS = 1.0   # ...and slower by at least this much, to ignore timer noise
+DEFAULT_MEMORY_THRESHOLD = 0.25  # Fail when a case's peak memory grows more than 25%...
+DEFAULT_MIN_DELTA_KB = 1024.0    # ...and by at least this much, to ignore allocator noise
+WARMUP_SIZE = (32, 32)       # Source size of the conversion that builds the lookup tables before peak memory is read
+TEST_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_images')
+
+
+def synthetic_image(size: Tuple[int, int]) -> Image.Image:
+    """
+    A deterministic photo-like test image: smooth color gradients, some
+    sharp edges and a little noise.
+    """
+    w, h = size
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    r = 128 + 100 * np.sin(x / (w / 7.0)) * np.cos(y / (h / 5.0))
+    g = 255 * x / w
+    b = 255 * y / h
+    rgb = np.stack([r, g, b], axis=2)
+    rgb[(x.astype(int) // max(1, w // 16) + y.astype(int) // max(1, h // 12)) % 5 == 0] *= 0.5
+    rgb += np.random.default_rng(0).normal(0, 6, rgb.shape)
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8), 'RGB')
+
+
+def build_corpus() -> Dict[str, bytes]:
+    """
+    The encoded source images to benchmark, keyed by a stable name.
+    """
+    corpus = {}
+    for size in SIZES:
+        image = synthetic_image(size)
+        for fmt in FORMATS:
+            buffer = BytesIO()
+            image.save(buffer, fmt)
+            corpus[f'synthetic-{size[0]}x{size[1]}.{fmt.lower()}'] = buffer.getvalue()
+
+    if os.path.isdir(TEST_IMAGES):
+        for name in sorted(os.listdir(TEST_IMAGES)):
+            with open(os.path.join(TEST_IMAGES, name), 'rb') as f:
+                data = f.read()
+            try:
+                Image.open(BytesIO(data)).verify()
+            except Exception:
+                continue  # not an image Pillow can read (e.g. a raw Atari screen)
+            corpus[f'test_images/{name}'] = data
+
+    return corpus
+
+
+@contextmanager
+def stage_timers(timings: Dict[str, float]) -> Iterator[None]:
+    """
+    Wrap yail's stage functions so each call adds its time to timings.
+    convertImageToYAIL looks them up as module globals, so it calls the
+    wrappers while they are installed.
+    """
+    def timed(stage: str, fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings[stage] += time.perf_counter() - start
+        return wrapper
+
+    originals = {}
+    for stage, names in STAGE_FUNCTIONS.items():
+        for name in names:
+            originals[name] = getattr(yail, name)
+            setattr(yail, name, timed(stage, originals[name]))
+    try:
+        yield
+    finally:
+        for name, fn in originals.items():
+            setattr(yail, name, fn)
+
+
+def run_stages(data: bytes, gfx_mode: int, dither: str, palette_mode: str) -> Dict[str, float]:
+    """
+    Convert one source image with convertImageToYAIL, timing each stage.
+
+    Returns:
+        dict: Seconds per stage
+    """
+    timings = {stage: 0.0 for stage in STAGES}
+
+    start = time.perf_counter()
+    with open_source_image(BytesIO(data), gfx_mode) as image:
+        image.load()
+        timings['decode'] = time.perf_counter() - start
+        with stage_timers(timings):
+            yail.convertImageToYAIL(image, gfx_mode, dither, palette_mode)
+    timings['total'] = time.perf_counter() - start
+
+    return timings
+
+
+def _proc_status_kb(field: str) -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def _reset_peak_rss() -> bool:
+    """
+    Reset the peak RSS to the current RSS (Linux), so a warm-up's transient
+    allocations do not hide the ones measured after it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_growth(data: bytes, gfx_mode: int, dither: str, palette_mode: str) -> int:
+    def max_rss() -> int:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024  # bytes on macOS, KB elsewhere
+
+    # Build the lookup tables and threshold maps first, so only the memory the
+    # conversion itself needs is measured
+    yail.convertImageToYAIL(synthetic_image(WARMUP_SIZE), gfx_mode, dither, palette_mode)
+
+    if _reset_peak_rss():
+        before = _proc_status_kb('VmRSS')
+        with open_source_image(BytesIO(data), gfx_mode) as image:
+            yail.convertImageToYAIL(image, gfx_mode, dither, palette_mode)
+        return (_proc_status_kb('VmHWM') - before) * 1024
+
+    # Without a resettable peak, growth is only seen above the warm-up's own peak
+    before = max_rss()
+    with open_source_image(BytesIO(data), gfx_mode) as image:
+        yail.convertImageToYAIL(image, gfx_mode, dither, palette_mode)
+    return max_rss() - before
+
+
+def peak_memory(data: bytes, gfx_mode: int, dither: str, palette_mode: str) -> Optional[int]:
+    """
+    How far one conversion raises the peak resident set size, measured in a
+    fresh process so earlier cases do not hide it, after a warm-up
+    conversion of a WARMUP_SIZE image so the one-time lookup tables and
+    threshold maps are not counted.  On Linux the peak is reset after the
+    warm-up; elsewhere only growth beyond the warm-up's peak shows.  The process is forked
+    from the forkserver, which run_benchmark starts before the corpus is
+    built: a process's peak RSS carries over through fork and exec, so one
+    started from the benchmark itself would begin at the corpus's size.
+
+    Returns:
+        int: Bytes, or None where getrusage is not available
+    """
+    if not RESOURCE_AVAILABLE:
+        return None
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=logging.disable, initargs=(logging.WARNING,)) as executor:
+        return executor.submit(_peak_rss_growth, data, gfx_mode, dither, palette_mode).result()
+
+
+def run_benchmark(repeat: int = DEFAULT_REPEAT, modes: List[str] = None, memory: bool = True) -> Dict:
+    """
+    Benchmark every mode over the corpus.
+
+    Returns:
+        dict: {'meta': {...}, 'results': {case: {stage: median ms, 'peak_kb': ...}}}
+    """
+    if memory and RESOURCE_AVAILABLE:
+        multiprocessing.forkserver.ensure_running()  # while this process is still small
+    corpus = build_corpus()
+    results = {}
+    for mode_name in modes or MODES:
+        gfx_mode, dither, palette_mode = MODES[mode_name]
+        for source_name, data in corpus.items():
+            case = f'{mode_name}/{source_name}'
+            run_stages(data, gfx_mode, dither, palette_mode)   # warm up caches and lookup tables
+            runs = [run_stages(data, gfx_mode, dither, palette_mode) for _ in range(repeat)]
+            result = {stage: round(statistics.median(run[stage] for run in runs) * 1000, 3) for stage in STAGES}
+            peak = peak_memory(data, gfx_mode, dither, palette_mode) if memory else None
+            if peak is not None:
+                result['peak_kb'] = round(peak / 1024, 1)
+            results[case] = result
+            logger.info(f"{case}: " + ', '.join(f"{stage} {result[stage]:.2f}ms" for stage in STAGES) +
+                        (f", peak +{result['peak_kb']}KB" if peak is not None else ''))
+
+    meta = {
+        'python': platform.python_version(),
+        'pillow': Image.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    return {'meta': meta, 'results': results}
+
+
+def compare(results: Dict, baseline: Dict, threshold: float, min_delta_ms: float,
+            memory_threshold: float = DEFAULT_MEMORY_THRESHOLD,
+            min_delta_kb: float = DEFAULT_MIN_DELTA_KB) -> List[str]:
+    """
+    Find the stages that are slower than the baseline by more than threshold
+    (a fraction) and min_delta_ms, and the cases whose peak memory grew by
+    more than memory_threshold and min_delta_kb.
+
+    Returns:
+        list: A description of each regression
+    """
+    regressions = []
+    for case, stages in results['results'].items():
+        base = baseline.get('results', {}).get(case)
+        if base is None:
+            continue
+        for stage in STAGES:
+            now, before = stages.get(stage), base.get(stage)
+            if now is None or before is None:
+                continue
+            if now > before * (1 + threshold) and now - before > min_delta_ms:
+                regressions.append(f'{case} {stage}: {before:.2f}ms -> {now:.2f}ms')
+
+        now, before = stages.get('peak_kb'), base.get('peak_kb')
+        if now is not None and before is not None:
+            if now > before * (1 + memory_threshold) and now - before > min_delta_kb:
+                regressions.append(f'{case} peak memory: +{before:.1f}KB -> +{now:.1f}KB')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YAIL encoder benchmark')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='Allowed slowdown per stage as a fraction (0.25 = 25%%)')
+    parser.add_argument('--min-delta-ms', type=float, default=DEFAULT_MIN_DELTA_MS, help='Ignore slowdowns smaller than this many milliseconds')
+    parser.add_argument('--memory-threshold', type=float, default=DEFAULT_MEMORY_THRESHOLD, help='Allowed peak memory growth per case as a fraction')
+    parser.add_argument('--min-delta-kb', type=float, default=DEFAULT_MIN_DELTA_KB, help='Ignore peak memory growth smaller than this many KB')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Runs per case (the median is reported)')
+    parser.add_argument('--modes', nargs='*', choices=list(MODES), help='Modes to benchmark (default all)')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the peak memory measurement (a process per case)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    yail.logger.setLevel(logging.WARNING)
+
+    results = run_benchmark(args.repeat, args.modes, not args.no_memory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms,
+                              args.memory_threshold, args.min_delta_kb)
+        if regressions:
+            logger.error(f'{len(regressions)} regression(s) beyond the thresholds:')
+            for regression in regressions:
+                logger.error(f'  {regression}')
+            sys.exit(1)
+        logger.info('No regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
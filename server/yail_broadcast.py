@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+YAIL Broadcast Module
+
+This module shares encoded camera frames between video clients.  Each
+captured frame is encoded at most once per graphics mode, and only when a
+client in that mode asks for it; every client in the mode is handed the same
+immutable payload.  Conversion work grows with the number of modes in use
+rather than the number of viewers, and a client that falls behind simply
+gets the newest frame, skipping the ones it missed.
+"""
+
+import logging
+import threading
+from typing import Callable, Dict, Hashable, Optional, Tuple
+from PIL import Image
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class FrameBroadcast:
+    """
+    The newest encoded frame of each graphics mode in use.
+
+        broadcast = FrameBroadcast(latest_frame, encode)
+        sequence, payload = broadcast.frame(key, after=last_sequence)
+
+    The key names everything that changes the encoding (graphics mode, dither
+    method, palette); it is passed to encode along with the image.
+    """
+
+    def __init__(self, source: Callable[[Optional[int]], Tuple[int, Optional[Image.Image]]],
+                 encode: Callable[[Image.Image, Hashable], bytes]):
+        """
+        Args:
+            source: Returns (sequence, image) for the newest captured frame,
+                waiting for one newer than the sequence it is given if it can
+            encode: Encodes an image for a key
+        """
+        self.source = source
+        self.encode = encode
+        self._frames: Dict[Hashable, Tuple[int, bytes]] = {}  # key -> (sequence, payload)
+        self._encoding: Dict[Hashable, int] = {}              # key -> sequence being encoded
+        self._cond = threading.Condition()
+        self.encoded = 0
+        self.shared = 0
+
+    def frame(self, key: Hashable, after: Optional[int] = None) -> Tuple[int, Optional[bytes]]:
+        """
+        The newest frame encoded for key.  If another client is already
+        encoding that frame for the same key, its result is waited for
+        instead of encoding it again.
+
+        Args:
+            key: What the frame is encoded for
+            after: The sequence number of the frame the client got last, so
+                a newer one is waited for briefly
+
+        Returns:
+            tuple: (sequence number, payload), or (sequence, None) if there is no frame
+        """
+        sequence, image = self.source(after)
+        if image is None:
+            return sequence, None
+
+        with self._cond:
+            while True:
+                cached = self._frames.get(key)
+                if cached is not None and cached[0] >= sequence:
+                    self.shared += 1
+                    return cached
+                if self._encoding.get(key, -1) < sequence:
+                    self._encoding[key] = sequence
+                    break
+                self._cond.wait()
+
+        try:
+            payload = bytes(self.encode(image, key))
+        except Exception:
+            with self._cond:
+                if self._encoding.get(key) == sequence:
+                    del self._encoding[key]
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self.encoded += 1
+            cached = self._frames.get(key)
+            if cached is None or cached[0] < sequence:
+                self._frames[key] = (sequence, payload)
+            if self._encoding.get(key) == sequence:
+                del self._encoding[key]
+            self._cond.notify_all()
+        return sequence, payload
+
+    def stats(self) -> Dict[str, int]:
+        """
+        How many frames were encoded and how many times one was shared instead.
+        """
+        with self._cond:
+            return {'modes': len(self._frames), 'encoded': self.encoded, 'shared': self.shared}
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+YAIL Cache Module
+
+This module contains the caches used by the YAIL server so that work which
+has already been done for one client can be reused for another: encoded
+frames, search results and failures in memory, and downloaded source images
+on disk.
+"""
+
+import os
+import json
+import time
+import tempfile
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_FRAME_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_SEARCH_CACHE_ENTRIES = 256
+DEFAULT_SEARCH_CACHE_TTL = 6 * 60 * 60  # Seconds a search result stays fresh
+DEFAULT_FAILURE_TTL = 10 * 60           # Seconds a failed URL, host or file is skipped
+DEFAULT_FAILURE_ENTRIES = 10000
+DEFAULT_SOURCE_CACHE_BYTES = 512 * 1024 * 1024
+SOURCE_CACHE_LOW_WATER = 0.9  # Eviction frees space down to this fraction of the limit
+
+
+def content_hash(data: bytes) -> str:
+    """
+    Hash the source bytes of an image so identical content shares a cache key
+    no matter which URL or file it came from.
+
+    Args:
+        data (bytes): The raw source bytes
+
+    Returns:
+        str: Hex digest of the content
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class FrameCache:
+    """
+    Thread-safe LRU cache of finished YAI payloads.
+    Entries are keyed by (content hash, gfx mode, target geometry) and evicted
+    least recently used first once the total payload size exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_FRAME_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(digest: str, gfx_mode: int, geometry: Tuple[int, int], variant: Hashable = None) -> Tuple:
+        """
+        Build the cache key for an encoded frame.
+
+        Args:
+            digest (str): Content hash of the source bytes
+            gfx_mode (int): The graphics mode the frame was encoded for
+            geometry (tuple): Target (width, height) of the frame
+            variant (hashable, optional): Any other encoding options that change the output
+
+        Returns:
+            tuple: The cache key
+        """
+        return (digest, gfx_mode, tuple(geometry), variant)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """
+        Look up an encoded frame and mark it as most recently used.
+
+        Returns:
+            bytes: The YAI payload or None on a miss
+        """
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key: Hashable, payload: bytes) -> None:
+        """
+        Store an encoded frame, evicting the least recently used entries to stay
+        within max_bytes.  Payloads larger than the whole cache are not stored.
+        """
+        payload = bytes(payload)  # immutable, so it can be shared between clients
+        if len(payload) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = payload
+            self.size += len(payload)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Remove all entries.  Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the cache counters.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def normalize_query(query: str) -> str:
+    """
+    The form of a search query used as its cache key: lower case, with runs
+    of whitespace collapsed.
+    """
+    return ' '.join(query.lower().split())
+
+
+class SearchCache:
+    """
+    Thread-safe cache of image search results shared by all clients.
+    Entries are keyed by normalized query, expire ttl seconds after they were
+    stored and are evicted least recently used first beyond max_entries.
+    The cache can be saved to and loaded from a JSON file, so it survives
+    restarts.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_SEARCH_CACHE_ENTRIES, ttl: float = DEFAULT_SEARCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[float, List[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query: str, max_results: int) -> Optional[List[str]]:
+        """
+        Look up the results of a search and mark them as most recently used.
+
+        Returns:
+            list: The result URLs, or None on a miss or if they have expired
+        """
+        key = (normalize_query(query), max_results)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query: str, max_results: int, urls: List[str]) -> None:
+        """
+        Store the results of a search.  Empty results are not stored, so a
+        failed search is retried.
+        """
+        if not urls or self.max_entries <= 0:
+            return
+
+        key = (normalize_query(query), max_results)
+        with self._lock:
+            self._entries[key] = (time.time(), list(urls))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self, path: str) -> None:
+        """
+        Write the unexpired entries to a JSON file, replacing it atomically.
+        """
+        now = time.time()
+        with self._lock:
+            entries = [[query, max_results, stored, urls]
+                       for (query, max_results), (stored, urls) in self._entries.items()
+                       if now - stored <= self.ttl]
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'entries': entries}, f)
+        os.replace(tmp_path, path)
+        logger.info(f'Saved {len(entries)} search results to {path}')
+
+    def load(self, path: str) -> None:
+        """
+        Read the entries saved by save(), skipping expired ones.  A missing,
+        unreadable or malformed file leaves the cache empty.
+        """
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not load search cache {path}: {e}')
+            return
+
+        now = time.time()
+        entries = OrderedDict()
+        try:
+            for query, max_results, stored, urls in saved.get('entries', []):
+                if not isinstance(urls, list):
+                    raise TypeError(f'URLs of {query!r} are a {type(urls).__name__}')
+                if now - stored <= self.ttl:
+                    entries[(query, max_results)] = (stored, urls)
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.warning(f'Ignoring malformed search cache {path}: {e}')
+            return
+
+        with self._lock:
+            self._entries.update(entries)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            logger.info(f'Loaded {len(self._entries)} search results from {path}')
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the cache counters.
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class FailureCache:
+    """
+    Thread-safe negative cache of image sources that recently failed (URLs,
+    hosts, files), shared by all clients so no session retries them.
+    Entries expire ttl seconds after the failure; beyond max_entries the
+    oldest failures are forgotten first.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_FAILURE_TTL, max_entries: int = DEFAULT_FAILURE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key: Hashable) -> None:
+        """
+        Record a failure of key.
+        """
+        if self.ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is None:
+                return False
+            if time.monotonic() > expires:
+                del self._entries[key]
+                return False
+            return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SourceCache:
+    """
+    On-disk cache of downloaded source images, safe to share between threads
+    and processes.  Image bytes are stored once per content hash under
+    objects/, and each URL maps to the hash of its content under urls/, so
+    the same picture found at several URLs is stored once.  Every file is
+    written to a temporary name and renamed into place.  A hit refreshes the
+    object's mtime, and the least recently used objects are evicted once
+    the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_SOURCE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._objects = os.path.join(directory, 'objects')
+        self._urls = os.path.join(directory, 'urls')
+        self._lock = threading.Lock()
+
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._urls, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(self._objects)
+                        if entry.is_file() and not entry.name.startswith('.tmp-'))
+        logger.info(f'Source cache {directory}: {self.size} bytes')
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self._urls, content_hash(url.encode('utf-8')))
+
+    def _write(self, path: str, data: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, url: str) -> Optional[bytes]:
+        """
+        Look up the source image downloaded from url.  The image is read
+        whole: it is decoded from memory anyway, and bytes need no closing.
+
+        Returns:
+            bytes: The image bytes, or None on a miss
+        """
+        try:
+            with open(self._url_path(url), 'r') as f:
+                digest = f.read().strip()
+            object_path = os.path.join(self._objects, digest)
+            with open(object_path, 'rb') as f:
+                data = f.read()
+            os.utime(object_path)
+        except OSError:
+            data = None  # No entry or an evicted object
+
+        if not data:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, url: str, data: bytes) -> None:
+        """
+        Store the source image downloaded from url, evicting the least
+        recently used images if the cache has grown too big.
+        """
+        if not data or len(data) > self.max_bytes:
+            return
+
+        digest = content_hash(data)
+        object_path = os.path.join(self._objects, digest)
+        try:
+            if os.path.exists(object_path):
+                os.utime(object_path)
+            else:
+                self._write(object_path, data)
+                with self._lock:
+                    self.size += len(data)
+            self._write(self._url_path(url), digest.encode('ascii'))
+        except OSError as e:
+            logger.warning(f'Could not cache {url}: {e}')
+            return
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used images until the cache is below its
+        low-water mark, and the URL entries that pointed to them.
+        """
+        with self._lock:
+            objects = []
+            for entry in os.scandir(self._objects):
+                try:
+                    if entry.is_file() and not entry.name.startswith('.tmp-'):
+                        stat = entry.stat()
+                        objects.append((stat.st_mtime, stat.st_size, entry.path))
+                except OSError:
+                    pass  # removed by another process
+
+            self.size = sum(size for _, size, _ in objects)
+            target = self.max_bytes * SOURCE_CACHE_LOW_WATER
+            for _, size, path in sorted(objects):
+                if self.size <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                self.size -= size
+                self.evictions += 1
+
+            for entry in os.scandir(self._urls):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                try:
+                    with open(entry.path, 'r') as f:
+                        digest = f.read().strip()
+                    if not os.path.exists(os.path.join(self._objects, digest)):
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the cache counters.
+        """
+        with self._lock:
+            return {'bytes': self.size, 'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
@@ -4,6 +4,11 @@ YAIL Camera Module
 
 This module contains the camera functionality for the YAIL server,
 including camera initialization, image capture, and processing.
+
+Once the camera is initialized, a capture thread keeps the newest frame in
+a lock-protected buffer with a sequence number, so video clients get the
+latest frame at once instead of waiting for the sensor.  The thread only
+captures while at least one video client is attached.
 """
 
 import os
@@ -30,13 +35,17 @@ except ImportError:
 SOCKET_WAIT_TIME = 1
 YAIL_W = 320
 YAIL_H = 220
+FRAME_WAIT_TIMEOUT = 2.0  # Seconds to wait for the first frame after capture resumes
+NEW_FRAME_TIMEOUT = 0.2   # Seconds to wait for a frame newer than the one a client already has
 
 # Global variables
-#camera_thread = None
-#camera_done = False
-#camera_name = None
-#camera_mutex = threading.Lock()
-#camera_image = None
+camera_thread = None
+camera_done = threading.Event()
+camera_active = threading.Event()    # Set while video clients are attached
+camera_mutex = threading.Condition()
+camera_image = None                  # The newest frame, None until one is captured
+camera_sequence = 0                  # Incremented for every frame captured
+camera_clients = 0
 
 cam = None
 
@@ -75,6 +84,8 @@ def init_camera(device_name: Optional[str] = None) -> bool:
         cam = pygame.camera.Camera(device_name, (YAIL_W, YAIL_H))
         cam.start()  # start the camera
 
+        start_camera_thread()
+
         return True
 
     except Exception as e:
@@ -82,9 +93,123 @@ def init_camera(device_name: Optional[str] = None) -> bool:
         return False
 
 
+def read_camera_frame(surface=None) -> Image.Image:
+    """
+    Read the sensor's next frame.
+
+    Args:
+        surface: A pygame surface to capture into, reused from frame to frame
+
+    Returns:
+        PIL.Image.Image: The frame
+    """
+    img = cam.get_image(surface) if surface is not None else cam.get_image()
+
+    # Convert pygame surface to PIL Image
+    img_str = pygame.image.tostring(img, 'RGB')
+    return Image.frombytes('RGB', img.get_size(), img_str)
+
+
+def camera_loop() -> None:
+    """
+    The capture thread: keep the newest frame in camera_image while video
+    clients are attached.  Each frame is a new image swapped in under the
+    lock, so readers can use the one they got without copying it.
+    """
+    global camera_image
+    global camera_sequence
+
+    surface = None
+    while not camera_done.is_set():
+        if not camera_active.wait(timeout=0.5):
+            continue
+
+        try:
+            frame = read_camera_frame(surface)
+            if surface is None:
+                surface = pygame.Surface(frame.size, 0, 24)
+        except Exception as e:
+            logger.error(f"Error capturing image from camera: {e}")
+            time.sleep(SOCKET_WAIT_TIME)
+            continue
+
+        with camera_mutex:
+            if not camera_active.is_set():
+                continue  # the last client left during the capture
+            camera_image = frame
+            camera_sequence += 1
+            camera_mutex.notify_all()
+
+
+def start_camera_thread() -> None:
+    """
+    Start the capture thread.  It stays paused until a video client attaches.
+    """
+    global camera_thread
+
+    if camera_thread is not None:
+        return
+
+    camera_done.clear()
+    camera_thread = threading.Thread(target=camera_loop, name='yail-camera', daemon=True)
+    camera_thread.start()
+
+
+def attach_camera_client() -> None:
+    """
+    Register a video client, resuming capture if it is the first.
+    """
+    global camera_clients
+
+    with camera_mutex:
+        camera_clients += 1
+        camera_active.set()
+
+
+def detach_camera_client() -> None:
+    """
+    Unregister a video client, pausing capture if it was the last.  The
+    frame captured before the pause is dropped, so nobody is sent a stale one.
+    """
+    global camera_clients
+    global camera_image
+
+    with camera_mutex:
+        camera_clients -= 1
+        if camera_clients <= 0:
+            camera_clients = 0
+            camera_active.clear()
+            camera_image = None
+
+
+def latest_camera_frame(after: Optional[int] = None,
+                        timeout: float = FRAME_WAIT_TIMEOUT) -> Tuple[int, Optional[Image.Image]]:
+    """
+    The newest frame from the capture thread, waiting only if none has been
+    captured since capture resumed.
+
+    Args:
+        after: The sequence number of the frame the caller already has; a
+            newer one is waited for up to NEW_FRAME_TIMEOUT before it is
+            returned again
+        timeout: Seconds to wait for a first frame
+
+    Returns:
+        tuple: (sequence number, PIL.Image.Image), or (sequence, None) if no frame arrived in time
+    """
+    with camera_mutex:
+        if camera_thread is None:
+            return camera_sequence, None
+        camera_mutex.wait_for(lambda: camera_image is not None or camera_done.is_set(), timeout)
+        if after is not None and camera_sequence <= after:
+            camera_mutex.wait_for(lambda: camera_sequence > after or camera_done.is_set(), NEW_FRAME_TIMEOUT)
+        return camera_sequence, camera_image
+
+
 def capture_camera_image(width: int = YAIL_W, height: int = YAIL_H) -> Optional[Image.Image]:
     """
-    Capture an image from the camera.
+    Capture an image from the camera.  With the capture thread running this
+    is the newest frame it has, otherwise the sensor is read directly.
     
     Args:
         width (int): Width of the captured image
@@ -93,7 +218,6 @@ def capture_camera_image(width: int = YAIL_W, height: int = YAIL_H) -> Optional[
     Returns:
         PIL.Image.Image: Captured image or None if capture failed
     """
-    #global camera_name
     global cam
     
     if not PYGAME_AVAILABLE:
@@ -104,15 +228,15 @@ def capture_camera_image(width: int = YAIL_W, height: int = YAIL_H) -> Optional[
         logger.error("Cannot capture image: camera not initialized")
         return None
     
+    if camera_thread is not None:
+        _, frame = latest_camera_frame()
+        if frame is None:
+            logger.error("Cannot capture image: no frame from the camera thread")
+        return frame
+
     try:
         # Capture an image
-        img = cam.get_image()
-        
-        # Convert pygame surface to PIL Image
-        img_str = pygame.image.tostring(img, 'RGB')
-        pil_img = Image.frombytes('RGB', img.get_size(), img_str)
-
-        return pil_img
+        return read_camera_frame()
     
     except Exception as e:
         logger.error(f"Error capturing image from camera: {e}")
@@ -123,12 +247,20 @@ def shutdown_camera() -> None:
     Shutdown the camera and release resources.
     """
     global cam
+    global camera_thread
     
     if not PYGAME_AVAILABLE:
         logger.error("Cannot shutdown camera: pygame not available")
         return
     
     try:
+        if camera_thread is not None:
+            camera_done.set()
+            with camera_mutex:
+                camera_mutex.notify_all()
+            camera_thread.join(timeout=2.0)
+            camera_thread = None
+
         if cam:
             cam.stop()
             cam = None
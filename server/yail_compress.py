@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+YAIL Compress Module
+
+This module compresses image blocks for clients that ask for it.  Line art,
+letterboxed frames and error-diffused images have long runs of equal bytes,
+and a run-length encoding is both smaller on the FujiNet's Wi-Fi and quick
+for a 6502 to undo.
+
+The encoding is PackBits: a control byte n of 0-127 is followed by n + 1
+literal bytes; n of 129-255 is followed by one byte repeated 257 - n times;
+128 is skipped.
+"""
+
+import logging
+import threading
+from typing import BinaryIO, Callable, Dict, Union
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+MAX_RUN = 128      # Longest literal or repeat run of one control byte
+MIN_REPEAT = 3     # Shorter runs are cheaper as part of a literal run
+
+
+def _literals(out: bytearray, data: np.ndarray, start: int, end: int) -> None:
+    for pos in range(start, end, MAX_RUN):
+        chunk = data[pos:min(pos + MAX_RUN, end)]
+        out.append(len(chunk) - 1)
+        out += chunk.tobytes()
+
+
+def rle_encode(data: Union[bytes, bytearray, memoryview]) -> bytearray:
+    """
+    Compress data with PackBits.  The input is scanned for runs with numpy,
+    so the Python loop only visits the runs worth encoding as repeats.
+
+    Args:
+        data: The bytes to compress
+
+    Returns:
+        bytearray: The compressed bytes (at most 1 byte per 128 bigger than data)
+    """
+    a = np.frombuffer(data, dtype=np.uint8)
+    out = bytearray()
+    if len(a) == 0:
+        return out
+
+    starts = np.concatenate(([0], np.flatnonzero(a[1:] != a[:-1]) + 1))
+    lengths = np.diff(np.concatenate((starts, [len(a)])))
+    repeats = lengths >= MIN_REPEAT
+
+    pos = 0
+    for start, length in zip(starts[repeats].tolist(), lengths[repeats].tolist()):
+        _literals(out, a, pos, start)
+        pos = start + length
+        while length >= 2:
+            count = min(length, MAX_RUN)
+            out.append(257 - count)
+            out.append(int(a[start]))
+            length -= count
+        if length:
+            _literals(out, a, pos - length, pos)
+    _literals(out, a, pos, len(a))
+
+    return out
+
+
+def rle_decode(data: Union[bytes, bytearray, memoryview]) -> bytearray:
+    """
+    Undo rle_encode(), as a client does.
+    """
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        n = data[pos]
+        pos += 1
+        if n < 128:
+            out += data[pos:pos + n + 1]
+            pos += n + 1
+        elif n > 128:
+            out += bytes([data[pos]]) * (257 - n)
+            pos += 1
+    return out
+
+
+class CompressionStats:
+    """
+    Bytes of image data before and after compression, across all clients.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.compressed = 0  # Frames sent compressed, the rest were smaller raw
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, raw_bytes: int, sent_bytes: int) -> None:
+        with self._lock:
+            self.frames += 1
+            self.compressed += sent_bytes < raw_bytes
+            self.raw_bytes += raw_bytes
+            self.sent_bytes += sent_bytes
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            ratio = self.raw_bytes / self.sent_bytes if self.sent_bytes else 1.0
+            return {'frames': self.frames, 'compressed': self.compressed, 'raw_bytes': self.raw_bytes,
+                    'sent_bytes': self.sent_bytes, 'ratio': round(ratio, 2)}
+
+
+class CompressingSocket:
+    """
+    Compresses the frames sent to a client that has enabled compression.
+    Has the sendall() and sendfile() of the socket it wraps, so it can be
+    passed to the streaming functions in its place.
+    """
+
+    def __init__(self, sock, compress: Callable[[bytes], bytes]):
+        """
+        Args:
+            sock: The client socket, or anything with sendall()
+            compress: Returns a packet compressed, or unchanged if it is not a frame
+                or would not get smaller
+        """
+        self.sock = sock
+        self.compress = compress
+
+    def sendall(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        self.sock.sendall(self.compress(data))
+
+    def sendfile(self, file: BinaryIO) -> None:
+        """
+        Send a pre-encoded file, compressed.  This gives up the zero-copy
+        send for fewer bytes on the wire.
+        """
+        self.sendall(file.read())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+YAIL Delta Module
+
+This module encodes video frames as changes against the previous frame a
+client received.  Consecutive webcam frames are mostly the same, so sending
+only the rows that changed is often a fraction of the 8.8 KB (GRAPHICS_8/9)
+or 77 KB (VBXE) of a full frame, which is what decides the frame rate over
+the FujiNet's Wi-Fi.
+
+A delta block holds a little-endian 16-bit run count, then for each run of
+changed rows its first row and row count (16 bits each) followed by the
+rows' image data.
+"""
+
+import struct
+import logging
+from typing import Hashable, Optional
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_KEYFRAME_INTERVAL = 30   # Frames between full frames
+MAX_DELTA_RATIO = 0.75           # A delta bigger than this fraction of the image is sent as a full frame
+DELTA_COUNT = struct.Struct('<H')
+DELTA_RUN = struct.Struct('<HH')  # first row, row count
+
+
+def row_delta(reference: bytes, pixels: bytes, row_bytes: int,
+              max_size: Optional[int] = None) -> Optional[bytearray]:
+    """
+    The delta block payload that turns reference into pixels.
+
+    Args:
+        reference: The image data the client has
+        pixels: The new image data, the same size as reference
+        row_bytes: Bytes per screen row
+        max_size: Give up on a delta bigger than this
+
+    Returns:
+        bytearray: The payload, or None if it would exceed max_size
+    """
+    ref = np.frombuffer(reference, dtype=np.uint8).reshape(-1, row_bytes)
+    cur = np.frombuffer(pixels, dtype=np.uint8).reshape(-1, row_bytes)
+    changed = np.any(ref != cur, axis=1).astype(np.int8)
+
+    # Runs of changed rows start where changed goes 0 -> 1 and end where it goes 1 -> 0
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], changed, [0]))))
+    starts, ends = edges[0::2], edges[1::2]
+
+    size = DELTA_COUNT.size + len(starts) * DELTA_RUN.size + int(changed.sum()) * row_bytes
+    if max_size is not None and size > max_size:
+        return None
+
+    delta = bytearray(size)
+    DELTA_COUNT.pack_into(delta, 0, len(starts))
+    offset = DELTA_COUNT.size
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        DELTA_RUN.pack_into(delta, offset, start, end - start)
+        offset += DELTA_RUN.size
+        run = cur[start:end].reshape(-1)
+        delta[offset:offset + len(run)] = run.tobytes()
+        offset += len(run)
+
+    return delta
+
+
+class DeltaEncoder:
+    """
+    The reference frame of one client.  Every frame passed to encode() is
+    assumed to reach the client, in order (the client asks for the next one
+    after receiving it), and becomes the reference for the following one.
+    """
+
+    def __init__(self, keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL):
+        """
+        Args:
+            keyframe_interval: Frames between full frames
+        """
+        self.keyframe_interval = keyframe_interval
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget the reference, so the next frame is a full frame.
+        """
+        self._key = None
+        self._palette = None
+        self._pixels = None
+        self._since_keyframe = 0
+
+    def encode(self, key: Hashable, palette: Optional[bytes], pixels: bytes, row_bytes: int) -> Optional[bytearray]:
+        """
+        Encode a frame against the reference.
+
+        Args:
+            key: What the frame is encoded for; a different key needs a full frame
+            palette: The frame's palette (VBXE), which must match the reference's
+            pixels: The frame's image data
+            row_bytes: Bytes per screen row
+
+        Returns:
+            bytearray: The delta block payload, or None if a full frame must be sent
+        """
+        delta = None
+        if (self._pixels is not None and key == self._key and palette == self._palette and
+                len(pixels) == len(self._pixels) and self._since_keyframe < self.keyframe_interval):
+            delta = row_delta(self._pixels, pixels, row_bytes, int(len(pixels) * MAX_DELTA_RATIO))
+
+        self._key = key
+        self._palette = palette
+        self._pixels = pixels
+        self._since_keyframe = self._since_keyframe + 1 if delta is not None else 0
+        return delta
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+YAIL Dither Module
+
+This module turns a grayscale image into the 1 bit per pixel plane used by
+GRAPHICS_8.  Ordered (Bayer, blue noise) and threshold dithering are a few
+NumPy operations per frame and suit video; error diffusion (Floyd-Steinberg,
+Atkinson) gives the best stills.
+"""
+
+import logging
+from functools import lru_cache
+from typing import Tuple
+import numpy as np
+from PIL import Image
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DITHER_METHODS = ('floyd', 'atkinson', 'bayer4', 'bayer8', 'bluenoise', 'threshold')
+DEFAULT_DITHER = 'floyd'
+ORDERED_DITHERS = ('bayer4', 'bayer8', 'bluenoise')
+BLUE_NOISE_SIZE = 64
+
+
+def bayer_matrix(n: int) -> np.ndarray:
+    """
+    Build an n x n Bayer index matrix (n a power of two) with values 0..n*n-1.
+    """
+    m = np.zeros((1, 1), dtype=np.int32)
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2],
+                      [4 * m + 3, 4 * m + 1]])
+    return m
+
+
+def blue_noise_matrix(n: int = BLUE_NOISE_SIZE, seed: int = 0) -> np.ndarray:
+    """
+    Build an n x n blue noise rank matrix with values 0..n*n-1 by high-pass
+    filtering white noise.  The filter is circular so the matrix tiles seamlessly.
+    """
+    noise = np.random.default_rng(seed).random((n, n))
+    fy = np.fft.fftfreq(n)[:, None]
+    fx = np.fft.fftfreq(n)[None, :]
+    filtered = np.real(np.fft.ifft2(np.fft.fft2(noise) * np.hypot(fx, fy)))
+    return filtered.argsort(axis=None).argsort().reshape(n, n)
+
+
+@lru_cache(maxsize=None)
+def threshold_map(method: str, shape: Tuple[int, int]) -> np.ndarray:
+    """
+    The per-pixel thresholds (0..255) of an ordered dither, tiled to shape.
+    """
+    if method == 'bayer4':
+        ranks = bayer_matrix(4)
+    elif method == 'bayer8':
+        ranks = bayer_matrix(8)
+    elif method == 'bluenoise':
+        ranks = blue_noise_matrix()
+    else:
+        raise ValueError(f"Not an ordered dither method: {method}")
+
+    thresholds = (ranks + 0.5) * (255.0 / ranks.size)
+    reps = (-(-shape[0] // ranks.shape[0]), -(-shape[1] // ranks.shape[1]))
+    tiled = np.tile(thresholds, reps)[:shape[0], :shape[1]].astype(np.float32)
+    tiled.setflags(write=False)
+    return tiled
+
+
+def atkinson(gray: np.ndarray) -> np.ndarray:
+    """
+    Atkinson error diffusion.  Only the error pushed along the current row is
+    carried pixel by pixel; what goes to the two rows below is added a row at a time.
+    """
+    h, w = gray.shape
+    buf = np.zeros((h + 2, w + 2), dtype=np.float32)
+    buf[:h, :w] = gray
+    out = np.zeros((h, w), dtype=bool)
+
+    for y in range(h):
+        row = buf[y].tolist()
+        bits = [False] * w
+        errs = [0.0] * (w + 2)
+        for x in range(w):
+            v = row[x]
+            on = v >= 128.0
+            e = (v - 255.0 if on else v) / 8.0
+            bits[x] = on
+            errs[x] = e
+            row[x + 1] += e
+            row[x + 2] += e
+        e = np.array(errs[:w], dtype=np.float32)
+        out[y] = bits
+        below = buf[y + 1]
+        below[:w] += e
+        below[1:w + 1] += e
+        below[:w - 1] += e[1:]
+        buf[y + 2, :w] += e
+
+    return out
+
+
+def dither_to_bits(image: Image.Image, method: str = DEFAULT_DITHER) -> np.ndarray:
+    """
+    Dither a grayscale image to one bit per pixel.
+
+    Args:
+        image (PIL.Image.Image): The image, mode 'L'
+        method (str): One of DITHER_METHODS
+
+    Returns:
+        np.ndarray: Boolean array, True where the pixel is lit
+    """
+    if method == 'floyd':
+        return np.asarray(image.convert('1'))
+
+    gray = np.asarray(image)
+    if method == 'threshold':
+        return gray >= 128
+    if method == 'atkinson':
+        return atkinson(gray)
+    if method in ORDERED_DITHERS:
+        return gray > threshold_map(method, gray.shape)
+
+    raise ValueError(f"Unknown dither method: {method}")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+YAIL Encoder Module
+
+This module runs the CPU-bound image conversion (resampling, dithering and
+palette quantization) in a pool of worker processes so that concurrent
+clients are not serialized by the GIL.  Source images are handed to the
+workers through shared memory instead of being pickled.
+"""
+
+import signal
+import logging
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Tuple
+from PIL import Image
+from yail_dither import DEFAULT_DITHER
+from yail_palette import DEFAULT_VBXE_PALETTE
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Pixel modes that can be rebuilt from raw bytes in the worker as they are
+SHARED_PIXEL_MODES = ('L', 'RGB')
+# Workers are started from a clean server process rather than forked from ours,
+# so they do not inherit the listening socket, client sockets or threads
+WORKER_START_METHOD = 'forkserver'
+
+
+def _init_worker(max_image_pixels: int) -> None:
+    import yail
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the workers too; the server shuts them down
+    yail.max_image_pixels = max_image_pixels
+
+
+def _encode_shared_bytes(name: str, size: int, gfx_mode: int, dither: str) -> bytes:
+    from yail import convertImageToYAIL, open_source_image
+
+    shm = shared_memory.SharedMemory(name=name)  # workers share our resource tracker; the caller unlinks
+    try:
+        with open_source_image(BytesIO(shm.buf[:size]), gfx_mode) as image:
+            return bytes(convertImageToYAIL(image, gfx_mode, dither))
+    finally:
+        shm.close()
+
+
+def _encode_shared_pixels(name: str, mode: str, image_size: Tuple[int, int], gfx_mode: int, dither: str,
+                          palette_mode: str) -> bytes:
+    from yail import convertImageToYAIL
+
+    shm = shared_memory.SharedMemory(name=name)
+    image = None
+    try:
+        image = Image.frombuffer(mode, image_size, shm.buf, 'raw', mode, 0, 1)
+        return bytes(convertImageToYAIL(image, gfx_mode, dither, palette_mode))
+    finally:
+        image = None  # release the shared buffer before closing it
+        shm.close()
+
+
+class EncoderPool:
+    """
+    A pool of worker processes that convert images to YAI payloads.
+    """
+
+    def __init__(self, workers: int, max_image_pixels: int):
+        """
+        Args:
+            workers (int): Number of worker processes
+            max_image_pixels (int): Source images with more pixels are rejected
+        """
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                             initargs=(max_image_pixels,),
+                                             mp_context=multiprocessing.get_context(WORKER_START_METHOD))
+        logger.info(f"Encoder pool started with {workers} workers")
+
+    def _run(self, data, worker, *args) -> bytes:
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        try:
+            shm.buf[:len(data)] = data
+            return self._executor.submit(worker, shm.name, *args).result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def encode_bytes(self, image_data: bytes, gfx_mode: int, dither: str = DEFAULT_DITHER) -> bytes:
+        """
+        Decode and convert an encoded source image (JPEG, PNG, ...) in a worker.
+
+        Args:
+            image_data (bytes): The encoded source image
+            gfx_mode (int): The graphics mode to use
+            dither (str): The GRAPHICS_8 dither method
+
+        Returns:
+            bytes: The YAI payload
+        """
+        return self._run(memoryview(image_data), _encode_shared_bytes, len(image_data), gfx_mode, dither)
+
+    def encode_image(self, image: Image.Image, gfx_mode: int, dither: str = DEFAULT_DITHER,
+                     palette_mode: str = DEFAULT_VBXE_PALETTE) -> bytes:
+        """
+        Convert an already decoded image in a worker.  A 'tracking' VBXE palette
+        follows the frames each worker happens to see.
+
+        Args:
+            image (PIL.Image.Image): The decoded image
+            gfx_mode (int): The graphics mode to use
+            dither (str): The GRAPHICS_8 dither method
+            palette_mode (str): The VBXE palette mode
+
+        Returns:
+            bytes: The YAI payload
+        """
+        if image.mode not in SHARED_PIXEL_MODES:
+            image = image.convert('RGB')
+        pixels = image.tobytes()
+        return self._run(pixels, _encode_shared_pixels, image.mode, image.size, gfx_mode, dither, palette_mode)
+
+    def shutdown(self) -> None:
+        """
+        Stop the worker processes.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
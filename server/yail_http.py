@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+YAIL HTTP Module
+
+This module contains the HTTP session shared by all image downloads.  Its
+connection pool keeps connections to recently used hosts alive, so fetching
+image after image from the same CDN pays for the TCP and TLS handshakes once.
+"""
+
+import logging
+from http.cookiejar import DefaultCookiePolicy
+from typing import Any, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_POOL_HOSTS = 32            # Hosts whose connections are kept alive
+DEFAULT_CONNECTIONS_PER_HOST = 8   # Connections open at once per host
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 5.0
+POOL_TIMEOUT = 10.0                # Longest wait for a free connection to a host
+CONNECTION_ERRORS = (requests.ConnectionError, requests.Timeout)  # Failures of the host rather than of one URL
+
+
+class WaitingPoolMixin:
+    """
+    Waits at most POOL_TIMEOUT for a free connection when the pool is full,
+    since requests never passes urllib3 a pool timeout and would wait forever.
+    """
+
+    def _get_conn(self, timeout: Optional[float] = None) -> Any:
+        return super()._get_conn(POOL_TIMEOUT if timeout is None else timeout)
+
+
+class WaitingHTTPConnectionPool(WaitingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class WaitingHTTPSConnectionPool(WaitingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class BlockingHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose pools hold downloads beyond their size until a
+    connection is free, for at most POOL_TIMEOUT.
+    """
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': WaitingHTTPConnectionPool,
+                                                   'https': WaitingHTTPSConnectionPool}
+
+
+def create_session(pool_hosts: int = DEFAULT_POOL_HOSTS,
+                   connections_per_host: int = DEFAULT_CONNECTIONS_PER_HOST) -> requests.Session:
+    """
+    Create a requests Session whose connection pool is shared by all client
+    threads.  At most connections_per_host connections to one host are open
+    at once; further downloads from it wait for one to be free, and fail
+    with urllib3's EmptyPoolError after POOL_TIMEOUT.  Cookies are never stored, so no state leaks from one client's download
+    to another's.
+
+    Args:
+        pool_hosts: Hosts whose connections are kept alive
+        connections_per_host: Connections open at once, and kept alive, per host
+
+    Returns:
+        requests.Session: The session
+    """
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = BlockingHTTPAdapter(pool_connections=pool_hosts, pool_maxsize=connections_per_host,
+                                  pool_block=True, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+YAIL Library Module
+
+This module pre-encodes the image files served in `files` mode into one pack
+file of ready YAI frames per graphics mode.  The packs are memory mapped so a
+`files`/`next` request for an unchanged image costs a lookup and a send.
+
+Each rebuild writes a new generation of the pack under its own name, then
+replaces the index that names it.  Replacing the index is the only step that
+publishes anything, so a crash at any point leaves a matching index and pack.
+"""
+
+import os
+import glob
+import json
+import mmap
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+LIBRARY_VERSION = 2
+DEFAULT_RESCAN_SECONDS = 60
+
+# An index entry: (mtime_ns, file size, offset in pack, frame length)
+IndexEntry = Tuple[int, int, int, int]
+# A file that could not be encoded: (mtime_ns, file size)
+FailedEntry = Tuple[int, int]
+
+
+class YaiPack:
+    """
+    One graphics mode's pack file and its offset index, opened with mmap.
+    """
+
+    def __init__(self, directory: str, gfx_mode: int):
+        self.gfx_mode = gfx_mode
+        self.directory = directory
+        self.index_path = os.path.join(directory, f'library_{gfx_mode}.json')
+        self.generation = 0
+        # The index and the mapping it points into, replaced together so readers never mix them
+        self.state: Tuple[Dict[str, IndexEntry], Optional[mmap.mmap]] = ({}, None)
+        self.failed: Dict[str, FailedEntry] = {}
+
+    @property
+    def entries(self) -> Dict[str, IndexEntry]:
+        return self.state[0]
+
+    def pack_name(self, generation: int) -> str:
+        return f'library_{self.gfx_mode}.{generation}.yaipack'
+
+    def load(self) -> bool:
+        """
+        Open an existing pack and index from disk.
+
+        Returns:
+            bool: True if a usable pack was loaded
+        """
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') != LIBRARY_VERSION or index.get('gfx_mode') != self.gfx_mode:
+                logger.info(f"Ignoring library index {self.index_path} from another version")
+                return False
+            generation = int(index['generation'])
+            pack_size = int(index['pack_size'])
+            entries = {path: tuple(entry) for path, entry in index['entries'].items()}
+            failed = {path: tuple(entry) for path, entry in index.get('failed', {}).items()}
+            if any(offset < 0 or length < 0 or offset + length > pack_size
+                   for _, _, offset, length in entries.values()):
+                raise ValueError("index entry outside the pack")
+            data = self._map(generation, pack_size)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning(f"Could not load library index {self.index_path}: {e}")
+            return False
+
+        self.generation = generation
+        self.state = (entries, data)
+        self.failed = failed
+        self._remove_stale(self.pack_name(generation))
+        return True
+
+    def _map(self, generation: int, pack_size: int) -> Optional[mmap.mmap]:
+        """
+        Map a pack generation, checking it is the size its index says.
+        """
+        with open(os.path.join(self.directory, self.pack_name(generation)), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size != pack_size:
+                raise ValueError(f"pack is {size} bytes, the index says {pack_size}")
+            if size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _remove_stale(self, keep: str) -> None:
+        """
+        Delete pack generations and temporary files other than keep.  Frames
+        handed out from an old generation stay readable through its mapping.
+        """
+        pattern = os.path.join(self.directory, f'library_{self.gfx_mode}.*')
+        for path in glob.glob(pattern):
+            name = os.path.basename(path)
+            if name == keep or path == self.index_path:
+                continue
+            if name.endswith('.yaipack') or name.endswith('.tmp'):
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    logger.warning(f"Could not remove old library file {path}: {e}")
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[memoryview]:
+        """
+        Return the frame for path if it was encoded from the file as it is now.
+        """
+        entries, data = self.state
+        entry = entries.get(path)
+        if entry is None or data is None:
+            return None
+        mtime_ns, size, offset, length = entry
+        if mtime_ns != stat.st_mtime_ns or size != stat.st_size:
+            return None
+        if offset + length > len(data):
+            logger.warning(f"Library frame for {path} is outside pack generation {self.generation}")
+            return None
+        return memoryview(data)[offset:offset + length]
+
+    def rebuild(self, paths: List[str], encode: Callable[[str, int], bytes],
+                stop: threading.Event) -> Tuple[int, int]:
+        """
+        Write a new pack holding a frame for every path.  Frames whose source is
+        unchanged are copied from the current pack, the rest are encoded.  The
+        new pack is written as the next generation, and is published by
+        atomically replacing the index with one that names it.
+
+        Returns:
+            tuple: (frames encoded, frames reused)
+        """
+        encoded = reused = 0
+        entries: Dict[str, IndexEntry] = {}
+        failed: Dict[str, FailedEntry] = {}
+        old_data = self.state[1]
+        generation = self.generation + 1
+        pack_name = self.pack_name(generation)
+        pack_path = os.path.join(self.directory, pack_name)
+        tmp_index = self.index_path + '.tmp'
+
+        with open(pack_path, 'wb') as pack:
+            offset = 0
+            for path in paths:
+                if stop.is_set():
+                    pack.close()
+                    os.unlink(pack_path)
+                    return encoded, reused
+                try:
+                    stat = os.stat(path)
+                except OSError as e:
+                    logger.warning(f"Skipping {path} in library: {e}")
+                    continue
+
+                # A file that failed before is only tried again once it changes
+                file_id = (stat.st_mtime_ns, stat.st_size)
+                if self.failed.get(path) == file_id:
+                    failed[path] = file_id
+                    continue
+
+                frame = self.get(path, stat) if old_data is not None else None
+                if frame is not None:
+                    reused += 1
+                else:
+                    try:
+                        frame = encode(path, self.gfx_mode)
+                    except Exception as e:
+                        logger.warning(f"Could not encode {path} for library: {e}")
+                        failed[path] = file_id
+                        continue
+                    encoded += 1
+
+                pack.write(frame)
+                entries[path] = (stat.st_mtime_ns, stat.st_size, offset, len(frame))
+                offset += len(frame)
+
+            # The pack must be on disk before an index that names it
+            pack.flush()
+            os.fsync(pack.fileno())
+
+        with open(tmp_index, 'w') as f:
+            json.dump({'version': LIBRARY_VERSION, 'gfx_mode': self.gfx_mode, 'generation': generation,
+                       'pack_size': offset, 'entries': entries, 'failed': failed}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_index, self.index_path)
+
+        # Frames already handed out keep the old mapping alive until they are sent
+        self.generation = generation
+        self.state = (entries, self._map(generation, offset))
+        self.failed = failed
+        self._remove_stale(pack_name)
+
+        return encoded, reused
+
+    def is_current(self, paths: List[str]) -> bool:
+        """
+        Check whether every path is in the index, as a frame or as a failure,
+        with its current size and mtime.  Paths that do not exist need no frame.
+        """
+        entries = self.state[0]
+        if set(entries).union(self.failed).difference(paths):
+            return False
+        for path in paths:
+            entry = entries.get(path) or self.failed.get(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                if entry is not None:
+                    return False
+                continue
+            if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+                return False
+        return True
+
+
+class YaiLibrary:
+    """
+    The pre-encoded library for a set of image files across graphics modes.
+    A background thread builds the packs and rescans the sources periodically,
+    re-encoding only the files that were added or changed.
+    """
+
+    def __init__(self, directory: str, paths: List[str], gfx_modes: List[int],
+                 encode: Callable[[str, int], bytes], rescan_seconds: int = DEFAULT_RESCAN_SECONDS):
+        """
+        Args:
+            directory (str): Where the pack and index files are kept
+            paths (list): The image files to pre-encode
+            gfx_modes (list): The graphics modes to build packs for
+            encode (callable): Converts (file path, gfx mode) to a YAI payload
+            rescan_seconds (int): How often to check the sources for changes
+        """
+        self.directory = directory
+        self.paths = paths
+        self.encode = encode
+        self.rescan_seconds = rescan_seconds
+        self.packs = {gfx_mode: YaiPack(directory, gfx_mode) for gfx_mode in gfx_modes}
+        self.hits = 0
+        self.misses = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Load any existing packs and start the background builder.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for pack in self.packs.values():
+            if pack.load():
+                logger.info(f"Loaded library pack for gfx mode {pack.gfx_mode}: {len(pack.entries)} frames")
+
+        self._thread = threading.Thread(target=self._run, name='yail-library', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background builder.
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1.0)
+
+    def get(self, path: str, gfx_mode: int) -> Optional[memoryview]:
+        """
+        Return the pre-encoded frame for a file, or None if the file is not in
+        the library for this mode or has changed since it was encoded.
+        """
+        pack = self.packs.get(gfx_mode)
+        if pack is None:
+            return None
+        try:
+            frame = pack.get(path, os.stat(path))
+        except OSError:
+            frame = None
+
+        if frame is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return frame
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            for pack in self.packs.values():
+                if self._stop.is_set():
+                    break
+                if pack.is_current(self.paths):
+                    continue
+                logger.info(f"Building library pack for gfx mode {pack.gfx_mode}...")
+                try:
+                    encoded, reused = pack.rebuild(self.paths, self.encode, self._stop)
+                    logger.info(f"Library pack for gfx mode {pack.gfx_mode}: {encoded} encoded, {reused} reused")
+                except Exception as e:
+                    logger.error(f"Error building library pack for gfx mode {pack.gfx_mode}: {e}")
+
+            self._stop.wait(self.rescan_seconds)
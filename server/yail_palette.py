@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+YAIL Palette Module
+
+This module contains the fast VBXE quantizer.  Instead of running a median
+cut on every frame, pixels are mapped to a 256 color palette through a
+precomputed 32x32x32 RGB lookup table.  The palette is either fixed or
+re-derived from the picture every few frames.
+"""
+
+import logging
+import threading
+from typing import List, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+from yail_dither import threshold_map
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+VBXE_PALETTE_MODES = ('adaptive', 'fixed', 'tracking')
+DEFAULT_VBXE_PALETTE = 'adaptive'
+LUT_BITS = 5                  # 32 levels per channel
+PALETTE_COLORS = 255          # The VBXE offset drops the last of 256 entries, so use 255
+DEFAULT_TRACKING_INTERVAL = 30
+DITHER_SPREAD = 48.0          # Amplitude of the ordered dither, about one palette step
+
+
+def fixed_palette() -> np.ndarray:
+    """
+    A fixed palette of 6 red x 7 green x 6 blue levels plus 3 extra grays.
+
+    Returns:
+        np.ndarray: (255, 3) uint8 colors
+    """
+    r, g, b = np.meshgrid(np.linspace(0, 255, 6), np.linspace(0, 255, 7), np.linspace(0, 255, 6), indexing='ij')
+    cube = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+    grays = np.repeat(np.array([[64.0], [128.0], [192.0]]), 3, axis=1)
+    return np.rint(np.vstack([cube, grays])).astype(np.uint8)
+
+
+def build_lut(palette: np.ndarray) -> np.ndarray:
+    """
+    Map every 5-bit-per-channel RGB cell to its nearest palette index.
+
+    Args:
+        palette (np.ndarray): (N, 3) uint8 colors
+
+    Returns:
+        np.ndarray: Flat uint8 table indexed by (r >> 3) << 10 | (g >> 3) << 5 | (b >> 3)
+    """
+    levels = np.arange(1 << LUT_BITS, dtype=np.float32) * (1 << (8 - LUT_BITS)) + (1 << (7 - LUT_BITS))
+    r, g, b = np.meshgrid(levels, levels, levels, indexing='ij')
+    cells = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+    colors = palette.astype(np.float32)
+    # |c - p|^2 without the |c|^2 term, which is the same for every palette entry
+    distance = (colors * colors).sum(axis=1)[None, :] - 2.0 * cells @ colors.T
+    return distance.argmin(axis=1).astype(np.uint8)
+
+
+def palette_bytes(palette: np.ndarray) -> List[int]:
+    """
+    The palette as the flat 768 entry list Pillow's getpalette() returns.
+    """
+    padded = np.zeros((256, 3), dtype=np.uint8)
+    padded[:len(palette)] = palette
+    return padded.ravel().tolist()
+
+
+class LutQuantizer:
+    """
+    Maps RGB pixels to a fixed palette through a lookup table.
+    """
+
+    def __init__(self, palette: np.ndarray):
+        self._lock = threading.Lock()
+        self._set_palette(palette)
+
+    def _set_palette(self, palette: np.ndarray) -> None:
+        lut = build_lut(palette)
+        with self._lock:
+            self._state = (palette_bytes(palette), lut)
+
+    def quantize(self, image: Image.Image, dither: Optional[str] = None) -> Tuple[List[int], np.ndarray]:
+        """
+        Quantize an RGB image.
+
+        Args:
+            image (PIL.Image.Image): The image, mode 'RGB'
+            dither (str, optional): An ordered dither method ('bayer4', 'bayer8' or 'bluenoise')
+
+        Returns:
+            tuple: (768 entry palette list, (h, w) uint8 palette indices)
+        """
+        palette, lut = self._state
+        rgb = np.asarray(image)
+
+        if dither:
+            offset = threshold_map(dither, rgb.shape[:2]) * (DITHER_SPREAD / 255.0) - DITHER_SPREAD / 2.0
+            rgb = np.clip(rgb + offset[:, :, None], 0, 255).astype(np.uint8)
+
+        shift = 8 - LUT_BITS
+        cells = rgb >> shift
+        index = (cells[:, :, 0].astype(np.uint16) << (2 * LUT_BITS)) | (cells[:, :, 1].astype(np.uint16) << LUT_BITS) | cells[:, :, 2]
+        return palette, lut[index]
+
+
+class TrackingQuantizer(LutQuantizer):
+    """
+    A LutQuantizer whose palette is re-derived from the picture (median cut)
+    every few frames, so it slowly follows the scene.
+    """
+
+    def __init__(self, interval: int = DEFAULT_TRACKING_INTERVAL):
+        self.interval = interval
+        self._frames = 0
+        super().__init__(fixed_palette())
+
+    def quantize(self, image: Image.Image, dither: Optional[str] = None) -> Tuple[List[int], np.ndarray]:
+        with self._lock:
+            refresh = self._frames % self.interval == 0
+            self._frames += 1
+
+        if refresh:
+            sample = image.quantize(colors=PALETTE_COLORS, method=Image.Quantize.MEDIANCUT)
+            palette = np.array(sample.getpalette()[:PALETTE_COLORS * 3], dtype=np.uint8).reshape(-1, 3)
+            self._set_palette(palette)
+            logger.debug(f"Tracking palette refreshed with {len(palette)} colors")
+
+        return super().quantize(image, dither)
+
+
+_quantizers = {}
+_quantizers_lock = threading.Lock()
+
+def get_quantizer(mode: str) -> LutQuantizer:
+    """
+    The shared quantizer for a VBXE palette mode ('fixed' or 'tracking').
+    """
+    with _quantizers_lock:
+        quantizer = _quantizers.get(mode)
+        if quantizer is None:
+            if mode == 'fixed':
+                quantizer = LutQuantizer(fixed_palette())
+            elif mode == 'tracking':
+                quantizer = TrackingQuantizer()
+            else:
+                raise ValueError(f"Unknown VBXE palette mode: {mode}")
+            _quantizers[mode] = quantizer
+        return quantizer
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+YAIL Prefetch Module
+
+This module keeps a few frames ready ahead of a client.  While the Atari
+shows one search result, the next ones are already being downloaded and
+encoded on a shared thread pool, so a `next` command is usually answered
+straight from the queue.  It also races several candidate images against
+each other when one has failed, serving whichever is ready first.
+"""
+
+import logging
+from collections import deque
+from concurrent.futures import Executor, as_completed
+from typing import Callable, Hashable, List, Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_PREFETCH_DEPTH = 2
+DEFAULT_PREFETCH_WORKERS = 8
+DEFAULT_RACE_WIDTH = 3
+
+
+class FramePrefetcher:
+    """
+    A queue of frames being produced in the background for one client.
+    The key records what the frames were produced for (e.g. the search
+    query and graphics mode); the owner replaces the prefetcher when it changes.
+    """
+
+    def __init__(self, executor: Executor, produce: Callable[[], Optional[bytes]], depth: int,
+                 key: Hashable = None):
+        """
+        Args:
+            executor: The pool the frames are produced on
+            produce: Produces one frame, or returns None if it failed
+            depth: Frames to keep queued
+            key: What the frames are for
+        """
+        self.executor = executor
+        self.produce = produce
+        self.depth = depth
+        self.key = key
+        self._futures = deque()
+        self.fill()
+
+    def fill(self) -> None:
+        """
+        Start producing frames until depth are queued.
+        """
+        while len(self._futures) < self.depth:
+            self._futures.append(self.executor.submit(self.produce))
+
+    def take(self) -> Optional[bytes]:
+        """
+        The next frame, waiting for it if it is still being produced.  Every
+        queued frame that failed is skipped and replaced.
+
+        Returns:
+            The frame, or None if all the queued attempts failed
+        """
+        for _ in range(len(self._futures)):
+            future = self._futures.popleft()
+            self.fill()  # start the replacement before waiting
+            try:
+                frame = future.result()
+            except Exception as e:
+                logger.warning(f'Prefetch failed: {e}')
+                frame = None
+            if frame is not None:
+                return frame
+        return None
+
+    def cancel(self) -> None:
+        """
+        Drop the queued frames.  Frames already being produced are left to finish.
+        """
+        for future in self._futures:
+            future.cancel()
+        self._futures.clear()
+
+
+def first_result(executor: Executor, produce: Callable[[Hashable], Optional[bytes]],
+                 candidates: List[Hashable]) -> Optional[bytes]:
+    """
+    Produce frames for several candidates at once and return the first that
+    succeeds.  The others are cancelled if they have not started; those
+    already running are left to finish in the background.  A single
+    candidate is produced on the calling thread.
+
+    Args:
+        executor: The pool the candidates are produced on
+        produce: Produces the frame for a candidate, or returns None if it failed
+        candidates: The candidates to race
+
+    Returns:
+        The first frame produced, or None if every candidate failed
+
+    Raises:
+        Exception: The last error raised by produce, if every candidate failed with one
+    """
+    if len(candidates) == 1:
+        return produce(candidates[0])
+
+    futures = [executor.submit(produce, candidate) for candidate in candidates]
+    error = None
+    try:
+        for future in as_completed(futures):
+            try:
+                frame = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if frame is not None:
+                return frame
+    finally:
+        for future in futures:
+            future.cancel()
+
+    if error is not None:
+        raise error
+    return None
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+YAIL Protocol Module
+
+This module splits the byte stream a client sends into command lines.  Each
+command ends with a newline (LF, CR or CR LF), so a command split across TCP
+segments is put back together and several pipelined commands in one segment
+are taken one at a time.
+"""
+
+import re
+import logging
+from typing import List, Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+MAX_LINE_LENGTH = 4096     # Longer lines are cut into commands of this size
+PARTIAL_LINE_TIMEOUT = 0.5  # Seconds before an unterminated line is taken as a command
+LINE_END = re.compile(rb'\r\n|\r|\n')
+
+
+class CommandParser:
+    """
+    Incremental parser of newline-delimited commands for one connection.
+
+        parser = CommandParser()
+        for line in parser.feed(data):
+            ...
+
+    Older clients send a command without a newline and wait for the reply.
+    The connection handler calls flush() once no more data has arrived for
+    PARTIAL_LINE_TIMEOUT seconds, so those commands still run.
+    """
+
+    def __init__(self, max_line_length: int = MAX_LINE_LENGTH):
+        self.max_line_length = max_line_length
+        self._buffer = bytearray()
+
+    @property
+    def pending(self) -> bool:
+        """
+        True if part of a command has been received without its newline.
+        """
+        return len(self._buffer) > 0
+
+    def feed(self, data: bytes) -> List[str]:
+        """
+        Add received data.
+
+        Args:
+            data: The bytes received from the client
+
+        Returns:
+            list: The commands completed by data, without their newlines.
+                Empty lines are skipped.
+        """
+        self._buffer += data
+        lines = []
+        start = 0
+        for match in LINE_END.finditer(self._buffer):
+            lines.append(self._decode(self._buffer[start:match.start()]))
+            start = match.end()
+        del self._buffer[:start]
+
+        # A line with no end in sight is taken in pieces rather than buffered without bound
+        while len(self._buffer) >= self.max_line_length:
+            logger.warning(f'Command longer than {self.max_line_length} bytes, splitting it')
+            lines.append(self._decode(self._buffer[:self.max_line_length]))
+            del self._buffer[:self.max_line_length]
+
+        return [line for line in lines if line]
+
+    def flush(self) -> Optional[str]:
+        """
+        Take the unterminated rest of the buffer as a command.
+
+        Returns:
+            str: The command, or None if nothing is buffered
+        """
+        line = self._decode(self._buffer)
+        self._buffer.clear()
+        return line or None
+
+    @staticmethod
+    def _decode(line: bytes) -> str:
+        return bytes(line).decode('UTF-8', errors='replace').strip()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+YAIL Search Module
+
+This module contains the URL pool behind a search session.  Search results
+arrive page by page; the pool is filled from them on a background thread and
+can be used as a list of URLs as soon as the first one is in, so the first
+image starts downloading while later pages are still on their way.  Later
+pages can be left unfetched until the client has used up the first.
+"""
+
+import logging
+import threading
+from typing import Iterable, Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+FIRST_URL_TIMEOUT = 30.0  # Seconds to wait for the first search result
+
+
+class UrlPool:
+    """
+    A list of URLs that grows in the background.  len() and indexing see the
+    URLs received so far, so it can be passed wherever a list of URLs is used.
+    """
+
+    def __init__(self, urls: Iterable[str] = (), background: bool = True,
+                 more: Optional[threading.Event] = None):
+        """
+        Args:
+            urls: The URLs, typically a generator yielding them as they arrive
+            background: Consume urls on a background thread (False takes them all now)
+            more: Set by want_more(), for a source that waits for it before fetching more
+        """
+        self.error = None
+        self.done = False
+        self.more = more
+        self._urls = []
+        self._cond = threading.Condition()
+
+        if background:
+            threading.Thread(target=self._fill, args=(urls,), name='yail-search', daemon=True).start()
+        else:
+            self._fill(urls)
+
+    def _fill(self, urls: Iterable[str]) -> None:
+        try:
+            for url in urls:
+                with self._cond:
+                    self._urls.append(url)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    def want_more(self) -> None:
+        """
+        Tell the source that more URLs are needed.
+        """
+        if self.more is not None:
+            self.more.set()
+
+    def wait(self, timeout: float = FIRST_URL_TIMEOUT) -> None:
+        """
+        Wait until the first URL has arrived or the search has ended.
+
+        Raises:
+            Exception: The error that ended the search, if it found nothing
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._urls or self.done, timeout)
+            if not self._urls and self.error is not None:
+                raise self.error
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._urls)
+
+    def __getitem__(self, index: int) -> str:
+        with self._cond:
+            return self._urls[index]
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+YAIL Send Module
+
+This module contains the buffered send path of the threaded server.  A
+handler's sendall() only copies the payload into the client's bounded
+outbound buffer; one SendPump thread waits for the client sockets to become
+writable and drains the buffers.  A handler can therefore prepare the next
+frame while a slow Wi-Fi client is still receiving the previous one, and only
+waits when the client has fallen a whole buffer behind.
+"""
+
+import socket
+import logging
+import selectors
+import threading
+from collections import deque
+from typing import BinaryIO, Optional, Union
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+DEFAULT_SEND_BUFFER = 160 * 1024   # Room for two VBXE frames
+CLOSE_FLUSH_TIMEOUT = 5.0          # Seconds to wait for the last frame when a client is closed
+
+
+def tune_socket(sock: Union[socket.socket, object], sndbuf: int = 0) -> None:
+    """
+    Set the send options of a client socket.  TCP_NODELAY lets the short
+    text responses go out at once instead of waiting behind Nagle's
+    algorithm; frames are written whole, so they fill full segments anyway.
+    The kernel's SO_SNDBUF auto-tuning is left alone unless sndbuf is given.
+
+    Args:
+        sock: The client socket
+        sndbuf: Kernel send buffer size in bytes (0 keeps the default)
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if sndbuf > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    except OSError as e:
+        logger.warning(f'Could not set socket options: {e}')
+
+
+class ClientWriter:
+    """
+    A bounded outbound buffer for one client socket, drained by a SendPump.
+    Has the sendall() and sendfile() of the socket it wraps, so it can be
+    passed to the streaming functions in its place.
+    """
+
+    def __init__(self, sock: socket.socket, pump: "SendPump", max_buffer: int = DEFAULT_SEND_BUFFER,
+                 timeout: Optional[float] = None):
+        """
+        Args:
+            sock: The client socket, which keeps being used for receiving
+            pump: The pump that drains the buffer
+            max_buffer: Bytes that may be waiting to be sent
+            timeout: Seconds sendall() waits for room before giving up on the client
+        """
+        self.sock = sock
+        self.pump = pump
+        self.max_buffer = max_buffer
+        self.timeout = timeout
+        self.pending = 0
+        self.error = None
+        self._chunks = deque()
+        self._cond = threading.Condition()
+        # A duplicate without a timeout, so the pump's sends never wait
+        self._send_sock = sock.dup()
+        self._send_sock.setblocking(False)
+
+    def _wait(self, predicate) -> None:
+        if not self._cond.wait_for(predicate, self.timeout):
+            raise socket.timeout('Client is not reading')
+        if self.error is not None:
+            raise self.error
+
+    def sendall(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        """
+        Queue data to be sent, waiting only while the buffer is full.  A
+        payload bigger than the whole buffer is accepted once the buffer is empty.
+
+        Raises:
+            OSError: If sending to the client failed
+            socket.timeout: If the client did not make room within the timeout
+        """
+        view = memoryview(data if isinstance(data, bytes) else bytes(data)).cast('B')  # copy anything mutable
+        if not view:
+            return
+
+        with self._cond:
+            self._wait(lambda: self.error is not None or self.pending == 0 or
+                       self.pending + len(view) <= self.max_buffer)
+            start = self.pending == 0
+            self._chunks.append(view)
+            self.pending += len(view)
+
+        if start:
+            self.pump.watch(self)
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """
+        Wait until everything queued has been sent.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.error is not None or self.pending == 0,
+                                       self.timeout if timeout is None else timeout):
+                raise socket.timeout('Client is not reading')
+            if self.error is not None:
+                raise self.error
+
+    def sendfile(self, file: BinaryIO) -> None:
+        """
+        Send a file with the socket's zero-copy sendfile once the buffer has drained.
+        """
+        self.flush()
+        self.sock.sendfile(file)
+
+    def close(self) -> None:
+        """
+        Give the client a few seconds to receive what is queued, then stop
+        sending.  The wrapped socket is left open for its owner to close.
+        """
+        try:
+            self.flush(CLOSE_FLUSH_TIMEOUT)
+        except OSError:
+            pass
+        self.pump.forget(self)
+
+    def on_writable(self) -> bool:
+        """
+        Send as much as the socket takes without blocking.  Called by the pump.
+
+        Returns:
+            True when the buffer is empty (or the client failed) and the socket
+            no longer needs watching
+        """
+        with self._cond:
+            try:
+                while self._chunks:
+                    view = self._chunks[0]
+                    sent = self._send_sock.send(view)
+                    self.pending -= sent
+                    if sent < len(view):
+                        self._chunks[0] = view[sent:]
+                        return False
+                    self._chunks.popleft()
+                return True
+            except (BlockingIOError, InterruptedError):
+                return False
+            except OSError as e:
+                self.error = e
+                self._chunks.clear()
+                self.pending = 0
+                return True
+            finally:
+                self._cond.notify_all()
+
+
+class SendPump:
+    """
+    One thread that drains the outbound buffers of all clients as their
+    sockets become writable.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._requests = deque()  # (writer, watch) pairs from other threads
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Start the pump thread.
+        """
+        self._thread = threading.Thread(target=self._run, name='yail-send', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the pump thread.  Data still queued is not sent.
+        """
+        self._stop.set()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    def watch(self, writer: ClientWriter) -> None:
+        """
+        Start draining a writer that has data queued.
+        """
+        self._requests.append((writer, True))
+        self._wake()
+
+    def forget(self, writer: ClientWriter) -> None:
+        """
+        Stop draining a writer and close its send socket.
+        """
+        self._requests.append((writer, False))
+        self._wake()
+
+    def _wake(self) -> None:
+        try:
+            self._wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # a wake-up is already pending, or the pump has stopped
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wakeup_recv:
+                    try:
+                        while self._wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif key.data.on_writable():
+                    self._selector.unregister(key.fileobj)
+
+            while self._requests:
+                writer, watch = self._requests.popleft()
+                registered = writer._send_sock in self._selector.get_map()
+                if watch:
+                    if not registered and not writer.on_writable():
+                        self._selector.register(writer._send_sock, selectors.EVENT_WRITE, writer)
+                else:
+                    if registered:
+                        self._selector.unregister(writer._send_sock)
+                    writer._send_sock.close()
+
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()